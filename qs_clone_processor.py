@@ -1,17 +1,28 @@
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import db
 import pickle
+from array import array
+import csv
+import gzip
+import io
+import json
+import mmap
+import struct
+import hashlib
 import time
+import heapq
+import bisect
+import random
+import shutil
+import signal
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from collections import OrderedDict
-from subprocess import Popen, PIPE
-import os, sys, traceback
-import glob2
-import matplotlib.pyplot as plt
+from collections import OrderedDict, Counter, deque, namedtuple
+from subprocess import Popen, PIPE, TimeoutExpired
+import os, re, sys, traceback
+import zlib
 from statistics import mean, median
 from datetime import datetime
-from dateutil import relativedelta
+from functools import lru_cache
+import numpy as np
 
 
 def write_file(filename, fcontent, mode, isprint):
@@ -46,21 +57,185 @@ def delete_file(filename):
     return True
 
 
-def connect_firebase():
-    # Fetch the service account key JSON file contents
-    cred = credentials.Certificate('cloverflow-exqs-outdated-firebase-adminsdk.json')
+FIREBASE_KEY = 'cloverflow-exqs-outdated-firebase-adminsdk.json'
+FIREBASE_URL = os.environ.get('FIREBASE_URL', 'https://cloverflow-exqs-outdated.firebaseio.com')
+FIREBASE_PAIRS = 'clones/pairs'
+# set by the db server on every pair this script writes (BatchedUpdater), used by sync_clones
+UPDATED_AT = 'updated_at'
+
 
-    # Initialize the app with a service account, granting admin privileges
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': 'https://cloverflow-exqs-outdated.firebaseio.com'
-    })
+def connect_firebase():
+    # firebase_admin is only imported on the paths that talk to the db
+    import firebase_admin
+    from firebase_admin import credentials
+    from firebase_admin import db
+    try:
+        # reuse the app initialized by an earlier call
+        firebase_admin.get_app()
+    except ValueError:
+        # Fetch the service account key JSON file contents
+        cred = credentials.Certificate(FIREBASE_KEY)
+
+        # Initialize the app with a service account, granting admin privileges
+        firebase_admin.initialize_app(cred, {
+            'databaseURL': FIREBASE_URL
+        })
     # Get a database reference to our clone pairs.
-    ref = db.reference('clones/pairs')
+    ref = db.reference(FIREBASE_PAIRS)
 
     return ref
 
 
-def download_clones():
+def get_access_token():
+    """
+    :return: OAuth2 access token for the REST API, None if there is no service account key (e.g. a local db)
+    """
+    if not Path(FIREBASE_KEY).exists():
+        return None
+    from firebase_admin import credentials
+    return credentials.Certificate(FIREBASE_KEY).get_access_token().access_token
+
+
+def firebase_rest_get(path, params, base_url=FIREBASE_URL, access_token=None, timeout=60):
+    """
+    Query the Realtime Database REST API
+    :param path: db path, e.g. clones/pairs
+    :param params: query parameters, values are JSON-encoded as the API expects (orderBy="$key")
+    :return: the decoded JSON response
+    """
+    import urllib.parse
+    import urllib.request
+    query = {k: json.dumps(v) for k, v in params.items()}
+    if access_token is not None:
+        query['access_token'] = access_token
+    url = base_url.rstrip('/') + '/' + path + '.json'
+    if query:
+        url += '?' + urllib.parse.urlencode(query)
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def as_pair_dict(result):
+    """ the REST API returns a list for dense integer keys and a dict otherwise """
+    if result is None:
+        return dict()
+    if isinstance(result, list):
+        return {key: pair for key, pair in enumerate(result) if pair is not None}
+    return {int(key): pair for key, pair in result.items() if pair is not None}
+
+
+def fetch_new_pairs(last_key, page_size, base_url=FIREBASE_URL, access_token=None):
+    """
+    Fetch the clone pairs with a key above last_key, page by page in key order
+    :return: dict of key -> clone pair
+    """
+    pairs = dict()
+    start = last_key + 1
+    while True:
+        page = as_pair_dict(firebase_rest_get(FIREBASE_PAIRS, {
+            'orderBy': '$key', 'startAt': str(start), 'limitToFirst': page_size
+        }, base_url, access_token))
+        pairs.update(page)
+        if len(page) < page_size:
+            return pairs
+        start = max(page) + 1
+
+
+def fetch_changed_pairs(watermark, page_size, base_url=FIREBASE_URL, access_token=None,
+                        field='latest_change_date'):
+    """
+    Fetch the clone pairs whose field is after the watermark, page by page
+    (pairs without the field are not returned)
+    :param watermark: the newest (millisecond) timestamp of the field that has been synced already
+    :param field: a timestamp field of the pairs, latest_change_date or UPDATED_AT
+    :return: dict of key -> clone pair
+    """
+    pairs = dict()
+    # startAt is inclusive, the pairs at the watermark have been synced already
+    start = watermark + 1
+    limit = page_size
+    while True:
+        page = as_pair_dict(firebase_rest_get(FIREBASE_PAIRS, {
+            'orderBy': field, 'startAt': start, 'limitToFirst': limit
+        }, base_url, access_token))
+        new_keys = [key for key in page if key not in pairs]
+        pairs.update(page)
+        if len(page) < limit:
+            return pairs
+        last = max(int(pair.get(field, 0)) for pair in page.values())
+        if not new_keys or last == start:
+            # a full page with a single change date, ask for a bigger page
+            limit *= 2
+        else:
+            # the next page starts with the pairs at the last date again, leave room for them
+            limit = page_size + sum(1 for pair in page.values() if int(pair.get(field, 0)) == last)
+        start = last
+
+
+def sync_clones(snapshot_file, page_size=1000, base_url=FIREBASE_URL, access_token=None):
+    """
+    Fetch only the clone pairs that are new or changed since the snapshot was taken and merge them into it.
+    New pairs are found by key, changed pairs by latest_change_date (a change of the code) and by
+    UPDATED_AT (an edit of the pair by this script, e.g. update_license); the watermarks are kept in the snapshot.
+    Edits made by other db clients that set neither field are not seen: run a full re-sync
+    (run --full-sync) from time to time to pick them up.
+    :return: no. of new pairs, no. of changed pairs
+    """
+    if access_token is None:
+        access_token = get_access_token()
+    snapshot = Snapshot(snapshot_file)
+    clones = snapshot.clones()
+    keys = snapshot.fixed['key'].tolist()
+    watermark = snapshot.info.get('watermark')
+    if watermark is None:
+        watermark = {'key': max(keys, default=-1)}
+    for field in ('latest_change_date', UPDATED_AT):
+        if field not in watermark:
+            watermark[field] = max((int(c.get(field, 0)) for c in clones), default=0)
+
+    started = time.time()
+    new_pairs = fetch_new_pairs(watermark['key'], page_size, base_url, access_token)
+    changed_pairs = fetch_changed_pairs(watermark['latest_change_date'], page_size, base_url, access_token)
+    changed_pairs.update(fetch_changed_pairs(watermark[UPDATED_AT], page_size, base_url, access_token,
+                                             field=UPDATED_AT))
+
+    merged = dict(zip(keys, clones))
+    new, changed = 0, 0
+    for key, pair in list(new_pairs.items()) + list(changed_pairs.items()):
+        if key not in merged:
+            new += 1
+        elif pair_metadata(pair) != pair_metadata(merged[key]):
+            changed += 1
+        else:
+            continue
+        merged[key] = pair
+    merged = dict(sorted(merged.items()))
+
+    fetched = list(changed_pairs.values()) + list(new_pairs.values())
+    watermark = {'key': max(merged, default=-1),
+                 'latest_change_date': max([watermark['latest_change_date']] +
+                                           [int(p.get('latest_change_date', 0)) for p in fetched]),
+                 UPDATED_AT: max([watermark[UPDATED_AT]] + [int(p.get(UPDATED_AT, 0)) for p in fetched])}
+    write_snapshot(merged, snapshot_file, downloaded=started, info={'watermark': watermark})
+    print('synced', new, 'new and', changed, 'changed clone pairs')
+    return new, changed
+
+
+SHARD_DIR = 'allclones.shards'
+
+
+def download_clones(chunked=False, shard_size=1000, workers=8, retries=5,
+                    shard_dir=SHARD_DIR, base_url=FIREBASE_URL, access_token=None):
+    """
+    Download all the clone pairs from the firebase db
+    :param chunked: split the key space into shards of shard_size keys and fetch them concurrently
+    :param workers: max. no. of shards fetched at the same time
+    :param retries: no. of retries (with exponential backoff) of a failed shard
+    :param shard_dir: shards are saved here as they arrive; a restarted download skips the saved ones
+    :return: list (or dict of key -> pair, when chunked) of clone pairs
+    """
+    if chunked:
+        return download_clones_chunked(shard_size, workers, retries, shard_dir, base_url, access_token)
     ref = connect_firebase()
     # download all clone pairs
     clones = ref.get()
@@ -71,6 +246,63 @@ def download_clones():
     return clones
 
 
+def with_retries(fn, retries, backoff=1.0):
+    """
+    Call fn, retrying failed (OSError, bad JSON) calls with exponential backoff and jitter
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except (OSError, ValueError):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+def fetch_shard(start, end, shard_dir, retries, base_url, access_token):
+    """
+    Fetch the clone pairs with keys from start to end (inclusive) and save them to the shard dir
+    :return: no. of clone pairs in the shard
+    """
+    pairs = with_retries(lambda: as_pair_dict(firebase_rest_get(FIREBASE_PAIRS, {
+        'orderBy': '$key', 'startAt': str(start), 'endAt': str(end)
+    }, base_url, access_token)), retries)
+    shard_file = os.path.join(shard_dir, '%d-%d.json' % (start, end))
+    with open(shard_file + '.tmp', 'w') as f:
+        json.dump(pairs, f)
+    os.replace(shard_file + '.tmp', shard_file)
+    return len(pairs)
+
+
+def download_clones_chunked(shard_size, workers, retries, shard_dir, base_url, access_token):
+    if access_token is None:
+        access_token = get_access_token()
+    # a shallow query only returns the keys
+    keys = sorted(int(k) for k in with_retries(
+        lambda: firebase_rest_get(FIREBASE_PAIRS, {'shallow': True}, base_url, access_token), retries) or [])
+    shards = [(keys[i], keys[min(i + shard_size, len(keys)) - 1]) for i in range(0, len(keys), shard_size)]
+
+    os.makedirs(shard_dir, exist_ok=True)
+    saved = set(os.listdir(shard_dir))
+    todo = [(start, end) for start, end in shards if '%d-%d.json' % (start, end) not in saved]
+    done, pairs = len(shards) - len(todo), 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_shard, start, end, shard_dir, retries, base_url, access_token)
+                   for start, end in todo]
+        for future in as_completed(futures):
+            pairs += future.result()
+            done += 1
+            print('\rdownloaded %d/%d shards (%d pairs)' % (done, len(shards), pairs), end='', flush=True)
+    print()
+
+    clones = dict()
+    for start, end in shards:
+        with open(os.path.join(shard_dir, '%d-%d.json' % (start, end))) as f:
+            clones.update((int(key), pair) for key, pair in json.load(f).items())
+    print("total clone pairs from the firebase db: ", len(clones))
+    return clones
+
+
 def clean(clones):
     print('removing null clone pairs.')
     filtered = []
@@ -82,32 +314,66 @@ def clean(clones):
     return filtered
 
 
-def write_clones_to_file(clones, columns, file_name, print_header=True, quote_on=False):
-    # clones = download_clones()
-    delete_file(file_name)
-    # write to a csv file
-    content = ""
+def open_output(file_name, compress=False):
+    """
+    Open a text file for writing, gzip-compressed if compress is set or the name ends with .gz
+    """
+    if compress or file_name.endswith('.gz'):
+        return gzip.open(file_name, 'wt', newline='')
+    return open(file_name, 'w', newline='', buffering=1 << 20)
 
-    if print_header:
-        for idx, c in enumerate(columns):
-            if idx < len(columns) - 1:
-                content += c + ","
-            else:
-                content += c + "\n"
 
-    if quote_on:
-        quote = "\""
-    else:
-        quote = ""
+def format_csv_rows(rows, quote_on):
+    """
+    :return: the rows formatted as CSV lines
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_ALL if quote_on else csv.QUOTE_MINIMAL, lineterminator='\n')
+    writer.writerows(rows)
+    return buf.getvalue()
 
-    for idx, clone in enumerate(clones):
-        for j, column in enumerate(columns):
-            if j != len(columns) - 1:
-                content += quote + str(clone[column]) + quote + ","
-            else:
-                content += quote + str(clone[column]) + quote + "\n"
 
-    write_file(file_name, content, "w", True)
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_clones_to_file(clones, columns, file_name, print_header=True, quote_on=False,
+                         compress=False, workers=1, chunk_size=10000):
+    """
+    Stream the clone pairs to a CSV file, row by row
+    :param clones: iterable of clone pairs
+    :param columns: the fields to write
+    :param quote_on: quote every value, otherwise only the values that need it
+    :param compress: gzip the output (also done when the file name ends with .gz)
+    :param workers: > 1 formats chunks of chunk_size rows in that many processes, written in order
+    :return: N/A
+    """
+    rows = ([str(clone[column]) for column in columns] for clone in clones)
+    with open_output(file_name, compress) as f:
+        if print_header:
+            f.write(format_csv_rows([columns], False))
+        if workers <= 1:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL if quote_on else csv.QUOTE_MINIMAL, lineterminator='\n')
+            writer.writerows(rows)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # keep a bounded no. of chunks in flight so memory stays constant
+                pending = deque()
+                for chunk in chunks(rows, chunk_size):
+                    pending.append(executor.submit(format_csv_rows, chunk, quote_on))
+                    if len(pending) >= 2 * workers:
+                        f.write(pending.popleft().result())
+                while pending:
+                    f.write(pending.popleft().result())
+    print("saved:" + file_name)
 
 
 def print_a_clone(clone, columns, print_header=True):
@@ -145,151 +411,459 @@ def print_latex(clone, columns, print_header=True):
     print(content)
 
 
-def snippet_in_list(snippets, c):
-    found = False;
-    for snippet in snippets:
-        if c["file1"].strip() == snippet["file1"].strip():
-            # already exist
-            found = True
-            return found
+def snippet_key(c):
+    return c["file1"].strip()
+
 
-    return found
+def clone_key(c):
+    return c["file1"].strip(), c["start1"], c["end1"]
 
 
-def clone_in_list(clones, c):
-    found = False;
+def dedup(clones, key=clone_key, selected=None):
+    """
+    Keep the first clone pair seen for each key, in their original order
+    :param clones: list of clone pairs
+    :param key: identity of a pair, clone_key (file1, start1, end1) or snippet_key (file1)
+    :param selected: optional predicate, pairs for which it returns False are skipped
+    :return: the unique clone pairs and all the selected clone pairs
+    """
+    seen = set()
+    uclones = []
+    allclones = []
     for clone in clones:
-        if c["file1"].strip() == clone["file1"].strip() \
-                and c["start1"] == clone["start1"] \
-                and c["end1"] == clone["end1"]:
-            # already exist
-            found = True
-            return found
+        if selected is not None and not selected(clone):
+            continue
+        allclones.append(clone)
+        k = key(clone)
+        if k not in seen:
+            seen.add(k)
+            uclones.append(clone)
 
-    return found
+    return uclones, allclones
 
 
 def get_unique_so_snippets(clones):
-    all_snippets = []
-    u_snippets = []
-    for idx, clone in enumerate(clones):
-        all_snippets.append(clone)
-        if not snippet_in_list(u_snippets, clone):
-            u_snippets.append(clone)
-
-    return u_snippets, all_snippets
+    return dedup(clones, snippet_key)
 
 
 def get_unique_so_snippets_with_filter(clones, selected_field, selected_value):
-    u_snippets = []
-    for idx, clone in enumerate(clones):
-        # filter unwanted clone pairs
-        if clone[selected_field] == selected_value:
-            if not snippet_in_list(u_snippets, clone):
-                u_snippets.append(clone)
-
+    u_snippets, _ = dedup(clones, snippet_key, lambda c: c[selected_field] == selected_value)
     return u_snippets
 
 
 def get_unique_so_clones_with_filter(clones, selected_field, selected_value):
-    allclones = []
-    uclones = []
-    for idx, clone in enumerate(clones):
-        # filter unwanted clone pairs
-        if clone[selected_field] == selected_value:
-            allclones.append(clone)
-            if not clone_in_list(uclones, clone):
-                uclones.append(clone)
+    return dedup(clones, clone_key, lambda c: c[selected_field] == selected_value)
+
+
+TEXT_FIELDS = ['notes', 'latest_note', 'od_reason_change', 'od_comment_outdated',
+               'od_newer_answer', 'od_higher-voted_answers']
+KEYWORD_TOKEN = re.compile(r'\w+')
+NO_POSITIONS = np.zeros(0, dtype=np.int64)
 
-    return uclones, allclones
+
+def keyword_tokens(text):
+    # casefold maps every character on its own, so a substring stays a substring
+    return KEYWORD_TOKEN.findall(text.casefold())
+
+
+class KeywordIndex:
+    """
+    Inverted index of the free-text fields of the clone pairs: field -> token (case-folded word)
+    -> sorted array of the positions of the pairs containing the token. A field is indexed on its first use.
+    """
+
+    def __init__(self, clones, fields=TEXT_FIELDS):
+        self.clones = clones
+        self.size = len(clones)
+        self.fields = list(fields)
+        self.postings = dict()
+        self.vocabulary = dict()
+        self.suffixes = dict()
+
+    def field(self, field):
+        """ :return: token -> positions of the pairs having it in the field """
+        if field not in self.postings:
+            # the text fields repeat a few values, tokenize every distinct value once
+            values = dict()
+            for pos, clone in enumerate(self.clones):
+                # a text field is a plain key of a SnapshotClone as well
+                values.setdefault(dict.get(clone, field), []).append(pos)
+            postings = dict()
+            for value, positions in values.items():
+                for token in set(keyword_tokens(str(value) if value is not None else '')):
+                    postings.setdefault(token, []).extend(positions)
+            # the positions of a token are sorted unless they came from more than one value
+            self.postings[field] = {token: np.unique(np.array(p, dtype=np.int64)) for token, p in postings.items()}
+            # sorted, so the tokens with a prefix are a slice of it
+            vocabulary = self.vocabulary[field] = sorted(postings)
+            # (token no., start) of every suffix of every token in the order of the suffixes,
+            # the tokens containing a word are those with a suffix starting with it
+            suffixes = [(i, start) for i, token in enumerate(vocabulary) for start in range(len(token))]
+            suffixes.sort(key=lambda suffix: vocabulary[suffix[0]][suffix[1]:])
+            self.suffixes[field] = np.array(suffixes, dtype=np.int64).reshape(-1, 2)
+        return self.postings[field]
+
+    def arrays(self):
+        """
+        :return: dict of name -> array of every field, to be saved with np.savez and loaded by from_arrays
+        """
+        arrays = dict()
+        for field in self.fields:
+            postings = self.field(field)
+            vocabulary = self.vocabulary[field]
+            # tokens are words, they do not contain spaces
+            arrays[field + '.vocabulary'] = np.array(' '.join(vocabulary))
+            arrays[field + '.offsets'] = np.cumsum([0] + [len(postings[token]) for token in vocabulary])
+            arrays[field + '.positions'] = np.concatenate([postings[token] for token in vocabulary] + [NO_POSITIONS])
+            arrays[field + '.suffixes'] = self.suffixes[field]
+        return arrays
+
+    @staticmethod
+    def from_arrays(clones, arrays, fields=TEXT_FIELDS):
+        index = KeywordIndex(clones, fields)
+        for field in fields:
+            text = str(arrays[field + '.vocabulary'])
+            vocabulary = text.split(' ') if text else []
+            offsets = arrays[field + '.offsets']
+            index.postings[field] = dict(zip(vocabulary, np.split(arrays[field + '.positions'], offsets[1:-1])))
+            index.vocabulary[field] = vocabulary
+            index.suffixes[field] = arrays[field + '.suffixes']
+        return index
+
+    def token(self, field, token):
+        return self.field(field).get(token.casefold(), NO_POSITIONS)
+
+    def prefix(self, field, prefix):
+        prefix = prefix.casefold()
+        postings = self.field(field)
+        vocabulary = self.vocabulary[field]
+        first = bisect.bisect_left(vocabulary, prefix)
+        last = bisect.bisect_left(vocabulary, prefix + '\U0010ffff')
+        return union_positions([postings[token] for token in vocabulary[first:last]])
+
+    def substring(self, field, word, suffix=False):
+        """
+        :param word: a case-folded word
+        :param suffix: only the tokens ending with the word instead of all the tokens containing it
+        :return: positions of the pairs having a token that contains (or ends with) the word in the field
+        """
+        postings = self.field(field)
+        vocabulary = self.vocabulary[field]
+        suffixes = self.suffixes[field]
+
+        def first(before):
+            # binary search for the first suffix that is not before(suffix)
+            lo, hi = 0, len(suffixes)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                i, start = suffixes[mid]
+                if before(vocabulary[i][start:]):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        lo = first(lambda s: s < word)
+        if suffix:
+            hi = first(lambda s: s <= word)
+        else:
+            hi = first(lambda s: s < word or s.startswith(word))
+        tokens = {vocabulary[i] for i in suffixes[lo:hi, 0].tolist()}
+        return union_positions([postings[token] for token in tokens])
+
+    def candidates(self, field, value):
+        """
+        Superset of the positions of the pairs whose field contains the substring value:
+        its first word may end a token, its last word may start one, the words between are tokens
+        :return: sorted array of positions, None if the value has no words to look up
+        """
+        words = keyword_tokens(value)
+        if not words:
+            return None
+        if len(words) == 1:
+            return self.substring(field, words[0])
+        positions = [self.substring(field, words[0], suffix=True)]
+        positions += [self.token(field, word) for word in words[1:-1]]
+        positions.append(self.prefix(field, words[-1]))
+        return intersect_positions(positions)
+
+    def term(self, term):
+        """
+        :param term: [field:]word[*], a word with punctuation (e.g. one-sided) matches all its words
+        :return: positions of the pairs having the term in the field, or in any field
+        """
+        field, _, word = term.rpartition(':')
+        fields = [field] if field in self.fields else self.fields
+        if field not in self.fields:
+            word = term
+        is_prefix = word.endswith('*')
+        words = keyword_tokens(word)
+        if not words:
+            return NO_POSITIONS
+        matches = []
+        for f in fields:
+            positions = [self.token(f, w) for w in words[:-1]]
+            positions.append(self.prefix(f, words[-1]) if is_prefix else self.token(f, words[-1]))
+            matches.append(intersect_positions(positions))
+        return union_positions(matches)
+
+    def search(self, query):
+        """
+        Boolean keyword query: terms next to each other (or joined by AND) must all match,
+        OR, NOT (or -term) and parentheses combine them, see term() for the terms,
+        e.g. 'one-sided OR (outdat* AND NOT latest_note:none)'
+        :return: sorted array of the positions of the matching pairs
+        """
+        tokens = re.findall(r'[()]|[^\s()]+', query)
+        pos = 0
+
+        def parse_or():
+            nonlocal pos
+            result = parse_and()
+            while pos < len(tokens) and tokens[pos] == 'OR':
+                pos += 1
+                result = union_positions([result, parse_and()])
+            return result
+
+        def parse_and():
+            nonlocal pos
+            result = parse_not()
+            while pos < len(tokens) and tokens[pos] not in ('OR', ')'):
+                if tokens[pos] == 'AND':
+                    pos += 1
+                result = intersect_positions([result, parse_not()])
+            return result
+
+        def parse_not():
+            nonlocal pos
+            if pos >= len(tokens):
+                raise ValueError('incomplete query: ' + query)
+            token = tokens[pos]
+            pos += 1
+            if token == 'NOT':
+                return np.setdiff1d(np.arange(self.size), parse_not(), assume_unique=True)
+            if token.startswith('-') and len(token) > 1:
+                return np.setdiff1d(np.arange(self.size), self.term(token[1:]), assume_unique=True)
+            if token == '(':
+                result = parse_or()
+                if pos >= len(tokens) or tokens[pos] != ')':
+                    raise ValueError('missing ) in query: ' + query)
+                pos += 1
+                return result
+            return self.term(token)
+
+        result = parse_or()
+        if pos < len(tokens):
+            raise ValueError('unexpected ' + tokens[pos] + ' in query: ' + query)
+        return result
+
+
+def union_positions(positions):
+    if not positions:
+        return NO_POSITIONS
+    if len(positions) == 1:
+        return positions[0]
+    merged = np.sort(np.concatenate(positions))
+    return merged[np.concatenate(([True], merged[1:] != merged[:-1]))]
+
+
+def intersect_positions(positions):
+    result = positions[0]
+    for p in positions[1:]:
+        result = np.intersect1d(result, p, assume_unique=True)
+    return result
 
 
 def get_unique_so_clones_keyword(clones, selected_field, selected_value):
-    allclones = []
-    uclones = []
-    for idx, clone in enumerate(clones):
-        # filter unwanted clone pairs
-        if selected_value in clone[selected_field]:
-            allclones.append(clone)
-            if not clone_in_list(uclones, clone):
-                uclones.append(clone)
+    """
+    Unique clone pairs whose field contains the value (a substring). Clone pairs of a snapshot
+    are looked up in its keyword index, only the candidates it returns are checked.
+    :return: the unique clone pairs and all the selected clone pairs
+    """
+    if clones and isinstance(clones[0], SnapshotClone) and selected_field in TEXT_FIELDS:
+        rows = clones[0].snapshot.keyword_index().candidates(selected_field, selected_value)
+        if rows is not None:
+            # positions of the candidates among the clones, in the order of the clones
+            candidates = np.flatnonzero(np.isin(np.fromiter((c.row for c in clones), dtype=np.int64,
+                                                            count=len(clones)), rows))
+            return dedup([clones[pos] for pos in candidates.tolist()], clone_key,
+                         lambda c: selected_value in c[selected_field])
+    return dedup(clones, clone_key, lambda c: selected_value in c[selected_field])
 
-    return uclones, allclones
 
+# comments, identifiers/keywords, numbers, string and char literals, any other (operator) character
+JAVA_TOKEN = re.compile(r'//[^\n]*|/\*.*?\*/|[A-Za-z_$][\w$]*|\d[\w.]*|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|\S',
+                        re.DOTALL)
+MINHASH_PRIME = (1 << 31) - 1
 
-def get_unique_so_clones(clones):
-    uclones = []
-    for idx, clone in enumerate(clones):
-        if not clone_in_list(uclones, clone):
-            uclones.append(clone)
 
+def code_tokens(code):
+    """ :return: the Java tokens of the code, without comments and whitespace """
+    return [token for token in JAVA_TOKEN.findall(code) if not token.startswith(('//', '/*'))]
+
+
+def shingles(tokens, size=3):
+    """
+    :param size: no. of tokens per shingle, code with fewer tokens is one shingle
+    :return: the distinct crc32 hashes of the shingles of the tokens
+    """
+    return np.unique(np.fromiter((zlib.crc32('\0'.join(tokens[i:i + size]).encode('utf-8'))
+                                  for i in range(max(len(tokens) - size + 1, 1))), dtype=np.uint64))
+
+
+class MinHasher:
+    """
+    MinHash signatures: the min. of num_perm random hash functions (a * x + b) mod p over the shingles.
+    Two signatures agree on a position with probability = Jaccard similarity of the shingle sets.
+    """
+
+    def __init__(self, num_perm=128, seed=1):
+        rng = np.random.RandomState(seed)
+        # a, b and the shingles (mod p) are < 2^31, so a * x + b cannot overflow 64 bits
+        self.a = rng.randint(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes):
+        hashes = hashes % MINHASH_PRIME
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MINHASH_PRIME).min(axis=1)
+
+
+def lsh_bands(threshold, num_perm):
+    """
+    Split the signatures into bands * rows = num_perm. Pairs of similarity s share a band
+    with probability 1 - (1 - s^rows)^bands, which rises steeply around (1/bands)^(1/rows).
+    :return: (bands, rows) with the highest such point not above the threshold, so pairs at
+        the threshold are likely candidates (the candidates are verified afterwards)
+    """
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    below = [split for split in splits if (1 / split[0]) ** (1 / split[1]) <= threshold]
+    return max(below or splits[-1:], key=lambda split: (1 / split[0]) ** (1 / split[1]))
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            # the root is the first item of the set
+            self.parent[max(i, j)] = min(i, j)
+
+    def labels(self):
+        return np.array([self.find(i) for i in range(len(self.parent))], dtype=np.int64)
+
+
+def cluster_near_duplicates(codes, threshold=0.8, num_perm=128, shingle_size=3, seed=1):
+    """
+    Group near-duplicate code in about linear time: MinHash signatures of the token shingles,
+    LSH banding to find candidate pairs and union-find to merge the candidates whose
+    estimated Jaccard similarity is at least the threshold
+    :param codes: the code text to cluster
+    :param threshold: min. similarity (0-1) of a pair of code in a cluster
+    :param num_perm: length of the MinHash signatures
+    :param shingle_size: no. of tokens per shingle
+    :return: array of the cluster of each code, as the index of the first code in the cluster
+    """
+    hasher = MinHasher(num_perm, seed)
+    signatures = np.array([hasher.signature(shingles(code_tokens(code), shingle_size)) for code in codes],
+                          dtype=np.uint64).reshape(-1, num_perm)
+    bands, rows = lsh_bands(threshold, num_perm)
+    clusters = UnionFind(len(signatures))
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        _, bucket, counts = np.unique(keys.view(np.dtype((np.void, rows * 8))).ravel(),
+                                      return_inverse=True, return_counts=True)
+        shared = np.flatnonzero(counts[bucket] > 1)
+        shared = shared[np.argsort(bucket[shared], kind='stable')]
+        for members in np.split(shared, np.flatnonzero(np.diff(bucket[shared])) + 1):
+            # compare with one member of each group found in the bucket so far
+            anchors = []
+            for i in members.tolist():
+                for anchor in anchors:
+                    if clusters.find(anchor) == clusters.find(i) or \
+                            np.mean(signatures[anchor] == signatures[i]) >= threshold:
+                        clusters.union(anchor, i)
+                        break
+                else:
+                    anchors.append(i)
+    return clusters.labels()
+
+
+def cluster_counts(labels):
+    """ :return: no. of clusters, no. of clusters of 2+ items, no. of items in them """
+    _, sizes = np.unique(labels, return_counts=True)
+    return len(sizes), int((sizes > 1).sum()), int(sizes[sizes > 1].sum())
+
+
+def get_unique_so_clones(clones):
+    uclones, _ = dedup(clones, clone_key)
     return uclones
 
 
-def get_outdated_clones(clones):
-    outdated_clones = []
+def partition_clones(clones, selected_field="classification"):
+    """
+    Split the clone pairs by the value of a field, e.g. the classification, in a single pass
+    :param clones: list of clone pairs
+    :param selected_field: the field to partition on
+    :return: dict of field value -> (unique clone pairs, all clone pairs, unique snippets)
+    """
+    partitions = dict()
     for clone in clones:
-        if clone["latest_ischanged"] == "true":
-            outdated_clones.append(clone)
+        value = clone[selected_field]
+        if value not in partitions:
+            partitions[value] = ([], [], [], set(), set())
+        uclones, allclones, usnippets, ckeys, skeys = partitions[value]
+        allclones.append(clone)
+        ckey = clone_key(clone)
+        if ckey not in ckeys:
+            ckeys.add(ckey)
+            uclones.append(clone)
+        skey = snippet_key(clone)
+        if skey not in skeys:
+            skeys.add(skey)
+            usnippets.append(clone)
 
-    return outdated_clones
+    return {value: p[:3] for value, p in partitions.items()}
 
 
-def get_projects_having_outdated_clones(clones):
-    projs_dict = dict()
-    for clone in clones:
-        if clone["latest_ischanged"] == "true":
-            proj = format_project_name(clone['file2'].split('/')[0])
-            if proj not in projs_dict:
-                projs_dict[proj] = 1
-            else:
-                projs_dict[proj] += 1
+def get_partition(partitions, value):
+    """
+    :return: (unique clone pairs, all clone pairs, unique snippets) of the value, empty if there is none
+    """
+    if value not in partitions:
+        return [], [], []
+    return partitions[value]
 
-    return projs_dict
 
+def get_outdated_clones(clones):
+    return outdated_analytics(clones).outdated
 
-def get_code_mod_types(clones):
-    mod_types = {
-            'latest_change_ad': 0,
-            'latest_change_md': 0,
-            'latest_change_rm': 0,
-            'latest_change_rw': 0,
-            'latest_change_ap': 0,
-            'latest_deleted': 0
-        }
-    for clone in clones:
-        mod_types['latest_change_ad'] += clone['latest_change_ad']
-        mod_types['latest_change_md'] += clone['latest_change_md']
-        mod_types['latest_change_rm'] += clone['latest_change_rm']
-        mod_types['latest_change_rw'] += clone['latest_change_rw']
-        mod_types['latest_change_ap'] += clone['latest_change_ap']
-        mod_types['latest_deleted'] += clone['latest_deleted']
 
-    return mod_types
+def get_projects_having_outdated_clones(clones):
+    return outdated_analytics(clones).short_projects
 
 
-def get_outdated_with_issues(clones):
-    issues_clones = []
-    for clone in clones:
-        if clone["latest_ischanged"] == "true" \
-                and clone["latest_note"].startswith("@"):
-            issues_clones.append(clone)
+def get_code_mod_types(clones):
+    return outdated_analytics(clones).mod_types
+
 
-    return issues_clones
+def get_outdated_with_issues(clones):
+    return outdated_analytics(clones).issues
 
 
 def get_qproject(clones):
-    projects = []
-    count = []
-    for clone in clones:
-        proj_name = clone['file2'].split('/')[0]
-        if proj_name not in projects:
-            projects.append(proj_name)
-            count.append(1)
-        else:
-            idx = projects.index(proj_name)
-            count[idx] += 1
-    return projects, count
+    if isinstance(clones, ClonePairTable):
+        return clones.qproject()
+    projects = count_projects(clones)
+    return list(projects), list(projects.values())
 
 
 # copied from
@@ -309,6 +883,522 @@ def read_list_from_file(file):
     return list
 
 
+NUMERIC_COLUMNS = ['start1', 'end1', 'start2', 'end2',
+                   'latest_change_ad', 'latest_change_md', 'latest_change_rm',
+                   'latest_change_rw', 'latest_change_ap', 'latest_deleted']
+# snippet = snippet_key(), the dedup key of the SO snippets (with start1/end1 that of the clones)
+CATEGORICAL_COLUMNS = ['classification', 'project', 'code1_license', 'code2_license', 'ex_license', 'snippet']
+MOD_TYPE_COLUMNS = ['latest_change_ad', 'latest_change_md', 'latest_change_rm',
+                    'latest_change_rw', 'latest_change_ap', 'latest_deleted']
+
+
+# the ASCII characters str.strip() removes
+STRIP_WHITESPACE = np.frombuffer(b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f', dtype=np.uint8)
+
+
+def line_offsets(data):
+    """ :return: byte offsets of the newlines in a utf-8 code blob """
+    return np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n')).astype('<u4')
+
+
+def stripped_numlines(data, newlines):
+    """
+    :param data: utf-8 code blob
+    :param newlines: its line_offsets
+    :return: no. of lines of the code once stripped, i.e. len(code.strip().split('\n'))
+    """
+    text = np.frombuffer(data, dtype=np.uint8)
+    kept = np.flatnonzero(~np.isin(text, STRIP_WHITESPACE))
+    if len(kept) == 0:
+        return 1
+    first, last = kept[0], kept[-1]
+    if text[first] >= 0x80 or text[last] >= 0x80:
+        # may start or end with non-ASCII whitespace, which only str.strip() knows
+        return len(bytes(data).decode('utf-8').strip().split('\n'))
+    return int(np.searchsorted(newlines, last) - np.searchsorted(newlines, first)) + 1
+
+
+class LineIndex:
+    """
+    The newline offsets of a code blob: line counts without splitting the code and
+    line ranges as memoryview slices of the blob
+    """
+    __slots__ = ('data', 'newlines', 'numlines')
+
+    def __init__(self, data, newlines=None, numlines=None):
+        """
+        :param data: utf-8 code blob (bytes, or a memoryview of a snapshot)
+        :param newlines: its line_offsets, computed if not given
+        :param numlines: its stripped_numlines, computed if not given
+        """
+        self.data = memoryview(data)
+        self.newlines = line_offsets(self.data) if newlines is None else newlines
+        self.numlines = stripped_numlines(self.data, self.newlines) if numlines is None else numlines
+
+    @staticmethod
+    def of(code):
+        return LineIndex(code.encode('utf-8'))
+
+    def line_range(self, start, end):
+        """
+        :return: memoryview of lines start to end (1-based, inclusive), the same lines
+            as '\n'.join(code.split('\n')[start - 1:end])
+        """
+        first, stop, _ = slice(start - 1, end).indices(len(self.newlines) + 1)
+        if first >= stop:
+            return self.data[0:0]
+        begin = int(self.newlines[first - 1]) + 1 if first else 0
+        finish = int(self.newlines[stop - 1]) if stop <= len(self.newlines) else len(self.data)
+        return self.data[begin:finish]
+
+    def text(self, start, end):
+        return str(self.line_range(start, end), 'utf-8')
+
+
+class CodeStore:
+    """
+    The code1/code2 text of the clone pairs, kept apart from the table and only loaded on request
+    """
+
+    def __init__(self, fetch, size, lines=None):
+        """
+        :param fetch: function (row, field_index) -> code text of the clone pair
+        :param size: no. of clone pairs in the store
+        :param lines: function (row, field_index) -> LineIndex of the code, default = index the fetched text
+        """
+        self.fetch = fetch
+        self.size = size
+        self.lines = lines or (lambda row, field_index: LineIndex.of(fetch(row, field_index)))
+        # line counts are computed once per row, -1 = not computed yet
+        self._numlines = {1: np.full(size, -1, dtype=np.int64), 2: np.full(size, -1, dtype=np.int64)}
+
+    def get(self, row, field_index):
+        return self.fetch(int(row), field_index)
+
+    def numlines(self, rows, field_index):
+        lines = self._numlines[field_index]
+        for row in rows[lines[rows] < 0]:
+            lines[row] = self.lines(int(row), field_index).numlines
+        return lines[rows]
+
+
+def encode_categorical(values, size):
+    """
+    Dictionary-encode a column of strings
+    :return: array of codes, list of categories (in first-seen order)
+    """
+    categories = dict()
+    codes = np.fromiter((categories.setdefault(v, len(categories)) for v in values), dtype=np.int32, count=size)
+    return codes, list(categories)
+
+
+class ClonePairTable:
+    """
+    Columnar view of the clone pairs: numeric columns as arrays, categorical columns
+    dictionary-encoded and the code text in a separate CodeStore.
+    """
+
+    def __init__(self, columns, categories, codes, rows, clones=None):
+        """
+        :param columns: dict of column name -> numpy array
+        :param categories: dict of categorical column name -> list of values (indexed by the codes in columns)
+        :param codes: CodeStore of the code text
+        :param rows: row number of each clone pair in the code store
+        :param clones: the clone pairs (dicts) the table was built from
+        """
+        self.columns = columns
+        self.categories = categories
+        self.codes = codes
+        self.rows = rows
+        self.clones = clones
+        self._index = None
+
+    @staticmethod
+    def from_clones(clones):
+        size = len(clones)
+        columns = dict()
+        for column in NUMERIC_COLUMNS:
+            columns[column] = np.fromiter((int(c.get(column, 0)) for c in clones), dtype=np.int64, count=size)
+        columns['latest_ischanged'] = np.fromiter((c.get('latest_ischanged') == 'true' for c in clones),
+                                                  dtype=bool, count=size)
+        categories = dict()
+        for column in CATEGORICAL_COLUMNS:
+            if column == 'project':
+                values = (project_of(c) for c in clones)
+            elif column == 'snippet':
+                values = (snippet_key(c) for c in clones)
+            else:
+                values = (c.get(column, '') for c in clones)
+            columns[column], categories[column] = encode_categorical(values, size)
+
+        codes = CodeStore(lambda row, field_index: clones[row]['code' + str(field_index)], size)
+        return ClonePairTable(columns, categories, codes, np.arange(size), clones)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def take(self, rows):
+        """
+        :param rows: positions (or a boolean mask) of the clone pairs to keep
+        :return: a table of the selected clone pairs sharing the categories and code store
+        """
+        columns = {name: column[rows] for name, column in self.columns.items()}
+        return ClonePairTable(columns, self.categories, self.codes, self.rows[rows])
+
+    def subset(self, clones):
+        """
+        :param clones: clone pairs (dicts) this table was built from, e.g. a partition of them
+        :return: a table of the given clone pairs, in the same order
+        """
+        # the table of a snapshot is not built from dicts: its pairs are found by their row
+        key = id if self.clones is not None else (lambda c: c.row)
+        if self._index is None:
+            self._index = {id(c): i for i, c in enumerate(self.clones)} if self.clones is not None \
+                else {row: i for i, row in enumerate(self.rows.tolist())}
+        return self.take(np.fromiter((self._index[key(c)] for c in clones), dtype=np.int64, count=len(clones)))
+
+    def labels(self, column):
+        """ :return: the values of a categorical column, one per clone pair """
+        return np.asarray(self.categories[column], dtype=object)[self.columns[column]].tolist()
+
+    def first_rows(self, *columns):
+        """
+        :return: positions of the first clone pair of each distinct combination of the columns, in order,
+            e.g. first_rows('snippet', 'start1', 'end1') dedups as clone_key does
+        """
+        _, first = np.unique(np.rec.fromarrays([self.columns[column] for column in columns]), return_index=True)
+        return np.sort(first)
+
+    def mask(self, column, value):
+        if column in self.categories:
+            if value not in self.categories[column]:
+                return np.zeros(len(self), dtype=bool)
+            return self.columns[column] == self.categories[column].index(value)
+        return self.columns[column] == value
+
+    def sizes(self, field_index=1):
+        # precomputed by the derived-metrics index of a snapshot
+        if 'size' + str(field_index) in self.columns:
+            return self.columns['size' + str(field_index)]
+        return self.columns['end' + str(field_index)] - self.columns['start' + str(field_index)] + 1
+
+    def mod_types(self):
+        return {column: int(self.columns[column].sum()) for column in MOD_TYPE_COLUMNS}
+
+    def clone_ratios(self, field_index):
+        if 'ratio' + str(field_index) in self.columns:
+            return self.columns['ratio' + str(field_index)]
+        return self.sizes(field_index) / self.codes.numlines(self.rows, field_index)
+
+    def avg_clone_ratio(self, field_index):
+        return float(self.clone_ratios(field_index).mean())
+
+    def value_counts(self, column):
+        """
+        :return: values of a categorical column in first-seen order, no. of clone pairs having each value
+        """
+        values, first, counts = np.unique(self.columns[column], return_index=True, return_counts=True)
+        order = np.argsort(first)
+        return [self.categories[column][v] for v in values[order]], counts[order].tolist()
+
+    def qproject(self):
+        return self.value_counts('project')
+
+
+def as_table(clones):
+    if isinstance(clones, ClonePairTable):
+        return clones
+    return ClonePairTable.from_clones(clones)
+
+
+SNAPSHOT_FILE = 'allclones.snapshot'
+SNAPSHOT_MAGIC = b'QSCLONES'
+SNAPSHOT_VERSION = 1
+# magic, schema version, flags (unused), download timestamp, offset and length of the info block
+SNAPSHOT_HEADER = struct.Struct('<8sIIdQQ')
+CODE_FIELDS = ('code1', 'code2')
+
+
+def snapshot_dtype():
+    """ the fixed-width record of a clone pair in a snapshot """
+    return np.dtype([('key', '<i8')] +
+                    [(column, '<i8') for column in NUMERIC_COLUMNS] +
+                    [('latest_ischanged', '?')] +
+                    [(column, '<i4') for column in CATEGORICAL_COLUMNS])
+
+
+def pair_metadata(clone):
+    """ :return: the fields of a clone pair except its code """
+    return {k: v for k, v in clone.items() if k not in CODE_FIELDS}
+
+
+def _pad(f):
+    # keep every section 8-byte aligned so it can be mapped as an array
+    f.write(b'\0' * (-f.tell() % 8))
+    return f.tell()
+
+
+def write_snapshot(clones, file, downloaded=None, info=None):
+    """
+    Write the clone pairs to a binary snapshot:
+    header | fixed-width records | metadata (json) | code blobs | code offsets |
+    line index (newline offsets, their offsets, line counts) | info (json)
+    :param clones: list (or dict) of clone pairs from the firebase db, null pairs are skipped
+    :param file: the snapshot file
+    :param downloaded: when the clone pairs were downloaded, default = now
+    :param info: extra values to keep in the info block
+    :return: N/A
+    """
+    if downloaded is None:
+        downloaded = time.time()
+    items = clones.items() if isinstance(clones, dict) else enumerate(clones)
+    keys, records = [], []
+    for key, clone in items:
+        if clone is not None:
+            keys.append(int(key))
+            records.append(clone)
+    table = ClonePairTable.from_clones(records)
+
+    fixed = np.zeros(len(records), dtype=snapshot_dtype())
+    fixed['key'] = keys
+    for column in table.columns:
+        fixed[column] = table.columns[column]
+
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(b'\0' * SNAPSHOT_HEADER.size)
+        sections = dict()
+        offset = _pad(f)
+        f.write(fixed.tobytes())
+        sections['fixed'] = [offset, f.tell() - offset]
+
+        offset = _pad(f)
+        for idx, record in enumerate(records):
+            f.write(((',' if idx else '[') + json.dumps(pair_metadata(record))).encode('utf-8'))
+        f.write(b']' if records else b'[]')
+        sections['meta'] = [offset, f.tell() - offset]
+
+        offset = _pad(f)
+        code_index = np.zeros(2 * len(records) + 1, dtype='<u8')
+        newlines, line_index = [], np.zeros(2 * len(records) + 1, dtype='<u8')
+        numlines = np.zeros(2 * len(records), dtype='<u4')
+        for idx, record in enumerate(records):
+            for j, field in enumerate(CODE_FIELDS):
+                data = record.get(field, '').encode('utf-8')
+                f.write(data)
+                code_index[2 * idx + j + 1] = f.tell() - offset
+                lines = LineIndex(data)
+                newlines.append(lines.newlines)
+                line_index[2 * idx + j + 1] = line_index[2 * idx + j] + len(lines.newlines)
+                numlines[2 * idx + j] = lines.numlines
+        sections['code'] = [offset, f.tell() - offset]
+
+        offset = _pad(f)
+        f.write(code_index.tobytes())
+        sections['code_index'] = [offset, f.tell() - offset]
+
+        for section, values in [('newlines', np.concatenate(newlines) if newlines else np.zeros(0, dtype='<u4')),
+                               ('line_index', line_index), ('numlines', numlines)]:
+            offset = _pad(f)
+            f.write(values.tobytes())
+            sections[section] = [offset, f.tell() - offset]
+
+        snapshot_info = dict(info or {})
+        snapshot_info.update({'size': len(records), 'sections': sections, 'categories': table.categories,
+                              'dtype': fixed.dtype.descr})
+        info_bytes = json.dumps(snapshot_info).encode('utf-8')
+        offset = _pad(f)
+        f.write(info_bytes)
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, downloaded, offset, len(info_bytes)))
+    os.replace(tmp_file, file)
+    print("save snapshot to file: " + file)
+
+
+class SnapshotClone(dict):
+    """
+    A clone pair read from a snapshot. code1/code2 are not kept in the dict,
+    they are read from the snapshot when accessed.
+    """
+    __slots__ = ('snapshot', 'row')
+
+    def __missing__(self, key):
+        if key in CODE_FIELDS:
+            return self.snapshot.code(self.row, CODE_FIELDS.index(key) + 1)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in CODE_FIELDS or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __reduce__(self):
+        # a plain dict with the code, the snapshot itself cannot be pickled
+        return dict, (dict(self, code1=self['code1'], code2=self['code2']),)
+
+
+class Snapshot:
+    """
+    A memory-mapped clone pair snapshot written by write_snapshot
+    """
+
+    def __init__(self, file):
+        self.file = file
+        with open(file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, _, self.downloaded, offset, length = SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(file + ' is not a clone snapshot')
+        if self.version != SNAPSHOT_VERSION:
+            raise ValueError(file + ' has schema version ' + str(self.version) +
+                             ', expected ' + str(SNAPSHOT_VERSION))
+        self.info = json.loads(self._mm[offset:offset + length].decode('utf-8'))
+        # identifies the snapshot content: the header has the download time, the info the layout
+        self.digest = hashlib.sha1(self._mm[:SNAPSHOT_HEADER.size] + self._mm[offset:offset + length] +
+                                   str(len(self._mm)).encode('utf-8')).hexdigest()
+        self.size = self.info['size']
+        sections = self.info['sections']
+        if 'dtype' in self.info:
+            dtype = np.dtype([tuple(field) for field in self.info['dtype']])
+        else:
+            # written before the records had their dtype in the info block (and a snippet column)
+            dtype = np.dtype([field for field in snapshot_dtype().descr if field[0] != 'snippet'])
+        self.fixed = np.frombuffer(self._mm, dtype=dtype, count=self.size, offset=sections['fixed'][0])
+        self.code_index = np.frombuffer(self._mm, dtype='<u8', count=2 * self.size + 1,
+                                        offset=sections['code_index'][0])
+        self._code_offset = sections['code'][0]
+        # the line index, not in snapshots written before it was added
+        self.newlines = self.line_index = self.numlines = None
+        if 'line_index' in sections:
+            self.newlines = np.frombuffer(self._mm, dtype='<u4', count=sections['newlines'][1] // 4,
+                                          offset=sections['newlines'][0])
+            self.line_index = np.frombuffer(self._mm, dtype='<u8', count=2 * self.size + 1,
+                                            offset=sections['line_index'][0])
+            self.numlines = np.frombuffer(self._mm, dtype='<u4', count=2 * self.size,
+                                          offset=sections['numlines'][0])
+        self._clones = None
+        self._table = None
+        self._keyword_index = None
+
+    def code(self, row, field_index):
+        idx = 2 * row + field_index - 1
+        start = self._code_offset + int(self.code_index[idx])
+        end = self._code_offset + int(self.code_index[idx + 1])
+        return self._mm[start:end].decode('utf-8')
+
+    def lines(self, row, field_index):
+        """
+        :return: LineIndex over the code blob in the mapped snapshot (nothing is copied or decoded)
+        """
+        idx = 2 * row + field_index - 1
+        data = memoryview(self._mm)[self._code_offset + int(self.code_index[idx]):
+                                    self._code_offset + int(self.code_index[idx + 1])]
+        if self.line_index is None:
+            return LineIndex(data)
+        return LineIndex(data, self.newlines[int(self.line_index[idx]):int(self.line_index[idx + 1])],
+                         int(self.numlines[idx]))
+
+    def clones(self):
+        """
+        :return: list of the clone pairs (SnapshotClone) without their code
+        """
+        if self._clones is None:
+            offset, length = self.info['sections']['meta']
+            self._clones = json.loads(self._mm[offset:offset + length].decode('utf-8'))
+            for row, meta in enumerate(self._clones):
+                clone = SnapshotClone(meta)
+                clone.snapshot = self
+                clone.row = row
+                self._clones[row] = clone
+        return self._clones
+
+    def keyword_index(self):
+        """
+        :return: KeywordIndex of the text fields of clones() (positions = rows), built on first use
+            and saved next to the snapshot like the derived metrics
+        """
+        if self._keyword_index is None:
+            index_file = self.file + '.keywords.npz'
+            identity = np.array([self.downloaded, self.size])
+            version = np.array(code_version(KeywordIndex))
+            if Path(index_file).exists():
+                with np.load(index_file) as saved:
+                    if np.array_equal(saved['snapshot'], identity) and saved['version'] == version:
+                        self._keyword_index = KeywordIndex.from_arrays(self.clones(), saved)
+                        return self._keyword_index
+            self._keyword_index = KeywordIndex(self.clones())
+            # --jobs workers may be loading the file, replace it in one step
+            with open(index_file + '.tmp', 'wb') as f:
+                np.savez(f, snapshot=identity, version=version, **self._keyword_index.arrays())
+            os.replace(index_file + '.tmp', index_file)
+            print("save keyword index to file: " + index_file)
+        return self._keyword_index
+
+    def table(self):
+        """
+        :return: ClonePairTable over the fixed-width records (nothing is decoded),
+            subset() accepts the clones() of this snapshot
+        """
+        if self._table is None:
+            columns = {column: self.fixed[column] for column in self.fixed.dtype.names if column != 'key'}
+            columns.update(self.metrics())
+            codes = CodeStore(self.code, self.size, self.lines)
+            self._table = ClonePairTable(columns, self.info['categories'], codes, np.arange(self.size))
+        return self._table
+
+
+    def metrics(self):
+        """
+        The derived-metrics index of the snapshot: clone size, line count of the code and
+        clone ratio of both sides of every pair. It is built on first use and saved next to
+        the snapshot, so the code is only read once per snapshot (and version of the metrics).
+        :return: dict of metric -> numpy array
+        """
+        metrics_file = self.file + '.metrics.npz'
+        identity = np.array([self.downloaded, self.size])
+        # metrics saved by another version of build_metrics or the line counting are stale too
+        version = np.array(code_version(build_metrics) + code_version(LineIndex))
+        if Path(metrics_file).exists():
+            with np.load(metrics_file) as saved:
+                if np.array_equal(saved['snapshot'], identity) and 'version' in saved.files \
+                        and saved['version'] == version:
+                    return {name: saved[name] for name in saved.files if name not in ('snapshot', 'version')}
+        metrics = build_metrics(self)
+        # --jobs workers may be loading the file, replace it in one step
+        with open(metrics_file + '.tmp', 'wb') as f:
+            np.savez(f, snapshot=identity, version=version, **metrics)
+        os.replace(metrics_file + '.tmp', metrics_file)
+        print("save derived metrics to file: " + metrics_file)
+        return metrics
+
+
+def build_metrics(snapshot):
+    """
+    :return: dict of size1/2, numlines1/2 and ratio1/2 -> array over the clone pairs of the snapshot
+    """
+    metrics = dict()
+    for field_index in (1, 2):
+        f = str(field_index)
+        metrics['size' + f] = snapshot.fixed['end' + f] - snapshot.fixed['start' + f] + 1
+        if snapshot.numlines is not None:
+            metrics['numlines' + f] = snapshot.numlines[field_index - 1::2].astype(np.int64)
+        else:
+            metrics['numlines' + f] = np.fromiter((snapshot.lines(row, field_index).numlines
+                                                   for row in range(snapshot.size)),
+                                                  dtype=np.int64, count=snapshot.size)
+        metrics['ratio' + f] = metrics['size' + f] / metrics['numlines' + f]
+    return metrics
+
+
+def convert_list_to_snapshot(list_file, snapshot_file):
+    """
+    Convert a pickled clone list (write_list_to_file) to a snapshot
+    """
+    clones = read_list_from_file(list_file)
+    write_snapshot(clones, snapshot_file, downloaded=os.path.getmtime(list_file))
+
+
 def plot_clone_size(clones):
     sizes = []
     for clone in clones:
@@ -320,16 +1410,21 @@ def plot_clone_size(clones):
 
 
 def get_numlines(code):
-    lines = code.strip().split('\n')
-    return len(lines)
+    return LineIndex.of(code).numlines
+
+
+def clone_lines(clone, field_index):
+    """ :return: LineIndex of code1/code2 of the clone pair, from the snapshot line index if it has one """
+    if isinstance(clone, SnapshotClone):
+        return clone.snapshot.lines(clone.row, field_index)
+    return LineIndex.of(clone['code' + str(field_index)])
 
 
 def get_clone_ratio(clone, field_index):
-    code_field = "code" + str(field_index)
     start_field = "start" + str(field_index)
     end_field = "end" + str(field_index)
 
-    size = get_numlines(clone[code_field])
+    size = clone_lines(clone, field_index).numlines
     # print(clone[start_field], clone[end_field])
     clone_size = clone[end_field] - clone[start_field] + 1
     # print(size, clone_size)
@@ -337,145 +1432,502 @@ def get_clone_ratio(clone, field_index):
 
 
 def get_avg_clone_ratio(clones, field_index):
-    total = 0
-    for clone in clones:
-        ratio = get_clone_ratio(clone, field_index)
-        total += ratio
-    return total/len(clones)
+    if isinstance(clones, ClonePairTable):
+        return clones.avg_clone_ratio(field_index)
+    return sum(get_clone_ratio(clone, field_index) for clone in clones) / len(clones)
+
+
+def project_of(clone):
+    """ :return: the (interned) Qualitas project name of the clone pair """
+    return sys.intern(clone['file2'].split('/')[0])
+
+
+def count_projects(clones, formatted=False):
+    """
+    Group the clone pairs by Qualitas project
+    :param formatted: group by the short name (format_project_name) instead of the full project name
+    :return: Counter of project -> no. of clone pairs, in first-seen order
+    """
+    projects = (project_of(clone) for clone in clones)
+    if formatted:
+        projects = (format_project_name(project) for project in projects)
+    return Counter(projects)
+
 
+def top_projects(counts, k=None):
+    """
+    Rank projects by no. of clone pairs (ties by name, both descending)
+    :param counts: dict of project -> no. of clone pairs
+    :param k: no. of projects to return, default = all
+    :return: list of (project, no. of clone pairs)
+    """
+    return heapq.nlargest(len(counts) if k is None else k, counts.items(), key=lambda item: (item[1], item[0]))
 
+
+@lru_cache(maxsize=None)
 def format_project_name(name):
     return name.replace("apache-", "").replace("_", "-").split('-')[0].lower()
 
 
-def plot_outdated(projects):
-    import matplotlib
-    import matplotlib.pyplot as plt;
-    plt.rcdefaults()
-    import numpy as np
-    import matplotlib.pyplot as plt
-    import matplotlib.figure as figure
-    from matplotlib.backends.backend_pdf import PdfPages
-    matplotlib.rcParams.update({'font.size': 16})
-
-    keys = list(projects.keys())
-    y_pos = np.arange(len(keys))
+def plot_outdated_spec(projects):
+    """
+    Figure spec of the bar chart 'outdated code grouped by projects' (see render_figures)
+    :param projects: dict of project -> no. of outdated pairs
+    """
     values = list(projects.values())
+    return {'kind': 'bar', 'file': 'outdated.pdf', 'keys': list(projects.keys()), 'values': values,
+            'ylabel': 'Pairs', 'yticks': [min(values), max(values) + 1, 3.0], 'size': [12, 4]}
+
 
-    fig, ax = plt.subplots()
-    plt.bar(y_pos, values, align='center')
-    plt.xticks(y_pos, keys)
-    plt.ylabel('Pairs')
-    labels = ax.get_xticklabels()
-    plt.yticks(np.arange(min(values), max(values) + 1, 3.0))
-    plt.setp(labels, rotation=30, ha='right')
-    fig.tight_layout()
-    # plt.show()
+def plot_outdated(projects):
+    render_figures([plot_outdated_spec(projects)])
 
-    pp = PdfPages('outdated.pdf')
-    fig.set_size_inches(12, 4)
-    pp.savefig(fig)
-    pp.close()
+
+def plot_mod_types_spec(mod_types):
+    """
+    Figure spec of the bar chart 'modifications made to outdated code' (see render_figures)
+    :param mod_types: dict of modification type -> no. of outdated pairs
+    """
+    keys = [ 'Stmt. addition', 'Stmt. modification', 'Stmt. removal', 'method rewriting', 'API change', 'file deletion' ]
+    return {'kind': 'bar', 'file': 'mod_types.pdf', 'keys': keys, 'values': list(mod_types.values()),
+            'ylabel': 'Pairs', 'size': [6, 6]}
 
 
 def plot_mod_types(mod_types):
-    import matplotlib
-    import matplotlib.pyplot as plt;
-    plt.rcdefaults()
-    import numpy as np
-    import matplotlib.pyplot as plt
-    import matplotlib.figure as figure
-    from matplotlib.backends.backend_pdf import PdfPages
-    matplotlib.rcParams.update({'font.size': 16})
+    render_figures([plot_mod_types_spec(mod_types)])
 
-    keys = [ 'Stmt. addition', 'Stmt. modification', 'Stmt. removal', 'method rewriting', 'API change', 'file deletion' ]
-    y_pos = np.arange(len(keys))
-    values = list(mod_types.values())
-
-    fig, ax = plt.subplots()
-    plt.bar(y_pos, values, align='center')
-    plt.xticks(y_pos, keys)
-    plt.ylabel('Pairs')
-    labels = ax.get_xticklabels()
-    # plt.yticks(np.arange(min(values), max(values) + 1, 1.0))
-    plt.setp(labels, rotation=30, ha='right')
-    fig.tight_layout()
-    # plt.show()
-
-    pp = PdfPages('mod_types.pdf')
-    fig.set_size_inches(6, 6)
-    pp.savefig(fig)
-    pp.close()
-
-
-def get_license(classification, clones):
-    licenses = dict()
-    column1 = 'code1_license'
-    column2 = 'code2_license'
+
+def license_columns(classification):
+    """
+    :return: the license fields of the SO snippet and of the other side of the clone pair
+    """
     if classification == "EX":
-        column1 = 'code1_license'
-        column2 = 'ex_license'
-    for idx, clone in enumerate(clones):
-        write_file('clone_licenses.csv',
-                   classification + ',' +
-                   clone['file1'] + ',' + clone['file2'] + ',' +
-                   clone[column1] + ',' + clone[column2] + '\n',
-                   'a', False)
-        key = clone[column1] + " & " + clone[column2]
-        if key not in licenses.keys():
-            licenses[key] = 1
+        return 'code1_license', 'ex_license'
+    return 'code1_license', 'code2_license'
+
+
+def count_licenses(classification, clones):
+    """
+    :return: Counter of 'SO license & other license' -> no. of clone pairs, in first-seen order
+    """
+    column1, column2 = license_columns(classification)
+    return Counter(clone[column1] + " & " + clone[column2] for clone in clones)
+
+
+class LicenseReportWriter:
+    """
+    Write the licenses of clone pairs (classification, file1, file2, license1, license2)
+    through one open file, as CSV or as a columnar Parquet file (needs pyarrow)
+    """
+    FIELDS = ['classification', 'file1', 'file2', 'license1', 'license2']
+
+    def __init__(self, file_name='clone_licenses.csv', format='csv', mode='w'):
+        self.file_name = file_name
+        self.format = format
+        if format == 'csv':
+            self.file = open(file_name, mode, newline='', buffering=1 << 20)
+            self.writer = csv.writer(self.file, lineterminator='\n')
+        elif format == 'parquet':
+            self.columns = {field: [] for field in self.FIELDS}
         else:
-            licenses[key] += 1
+            raise ValueError('unknown license report format: ' + format)
 
-    return licenses
+    def write(self, classification, clones):
+        column1, column2 = license_columns(classification)
+        if self.format == 'csv':
+            self.writer.writerows((classification, c['file1'], c['file2'], c[column1], c[column2]) for c in clones)
+        else:
+            for c in clones:
+                for field, value in zip(self.FIELDS, (classification, c['file1'], c['file2'], c[column1], c[column2])):
+                    self.columns[field].append(value)
+
+    def close(self):
+        if self.format == 'csv':
+            self.file.close()
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(pyarrow.table(self.columns), self.file_name)
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def get_license(classification, clones, writer=None):
+    """
+    Count the license combinations of the clone pairs and write their licenses to the report
+    :param writer: LicenseReportWriter, default = append to clone_licenses.csv
+    :return: dict of 'SO license & other license' -> no. of clone pairs
+    """
+    if writer is None:
+        with LicenseReportWriter('clone_licenses.csv', mode='a') as report:
+            report.write(classification, clones)
+    else:
+        writer.write(classification, clones)
+    return count_licenses(classification, clones)
+
+
+class BatchedUpdater:
+    """
+    Collect updates of clone pairs and send them to the db as one multi-path update
+    every max_pairs pairs or max_seconds seconds, whichever comes first.
+    Every updated pair gets the server time in UPDATED_AT, so sync_clones sees the edit.
+    """
+
+    def __init__(self, ref, max_pairs=500, max_seconds=5.0):
+        self.ref = ref
+        self.max_pairs = max_pairs
+        self.max_seconds = max_seconds
+        self.pending = dict()
+        self.pending_pairs = 0
+        self.pairs = 0
+        self.requests = 0
+        self.started = time.time()
+        self.last_flush = self.started
+
+    def update(self, idx, values):
+        for field, value in values.items():
+            self.pending[str(idx) + '/' + field] = value
+        self.pending[str(idx) + '/' + UPDATED_AT] = {'.sv': 'timestamp'}
+        self.pending_pairs += 1
+        if self.pending_pairs >= self.max_pairs or time.time() - self.last_flush >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.ref.update(self.pending)
+            self.requests += 1
+            self.pairs += self.pending_pairs
+            self.pending = dict()
+            self.pending_pairs = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        elapsed = max(time.time() - self.started, 1e-9)
+        print('updated', self.pairs, 'pairs in', self.requests, 'requests',
+              '(%.1f pairs/s)' % (self.pairs / elapsed))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+NINKA = os.environ.get('NINKA', '/Users/Chaiyong/Downloads/stackoverflow/tools/ninka-1.3/ninka.pl')
+SO_ROOT = os.environ.get('SO_ROOT', '/Users/Chaiyong/Downloads/stackoverflow/stackoverflow_orig/')
+QUALITAS_ROOT = os.environ.get('QUALITAS_ROOT',
+                               '/Users/Chaiyong/Downloads/stackoverflow/QualitasCorpus-20130901r/projects_orig_130901/')
+LICENSE_CACHE = os.environ.get('LICENSE_CACHE', 'ninka_cache.sqlite')
+
+
+def update_license(classification, clones, max_pairs=500, max_seconds=5.0, workers=None, timeout=60,
+                   cache_file=LICENSE_CACHE):
+    pairs = [(idx, clone) for idx, clone in enumerate(clones) if clone['classification'] == classification]
+    files = [SO_ROOT + clone['file1'] for _, clone in pairs] + [QUALITAS_ROOT + clone['file2'] for _, clone in pairs]
+    cache = LicenseCache(cache_file) if cache_file is not None else None
+    licenses = scan_licenses(files, workers=workers, timeout=timeout, cache=cache)
+    if cache is not None:
+        cache.close()
+    solicenses, qlicenses = licenses[:len(pairs)], licenses[len(pairs):]
 
-def update_license(classification, clones):
     ref = connect_firebase()
     count = 0
-    for idx, clone in enumerate(clones):
-        if clone['classification'] == classification:
+    with BatchedUpdater(ref, max_pairs, max_seconds) as updater:
+        for (idx, clone), solicense, qlicense in zip(pairs, solicenses, qlicenses):
             count += 1
-            fileloc = '/Users/Chaiyong/Downloads/stackoverflow/stackoverflow_orig/' + clone['file1']
-            solicense = run_ninka(fileloc).split(';')[1].replace('\\n\'', '').replace(',', '/')
-            solicense = solicense.replace('NONE', 'No license')
-
-            fileloc = '/Users/Chaiyong/Downloads/stackoverflow/QualitasCorpus-20130901r/projects_orig_130901/' + clone[
-                'file2']
-            qlicense = run_ninka(fileloc).split(';')[1].replace('\\n\'', '').replace(',', '/')
-            qlicense = qlicense.replace('NONE', 'No license')
-
+            if solicense is None or qlicense is None:
+                print(count, 'ninka timed out, skipped id', idx)
+                continue
             # add license to the clone pair
-            pairs_ref = ref.child(str(idx))
-            pairs_ref.update({
+            updater.update(idx, {
                 'code1_license': solicense,
                 'code2_license': qlicense
             })
             print(count, 'done updating id', idx)
 
 
-def run_ninka(file):
-    p = Popen(["/Users/Chaiyong/Downloads/stackoverflow/tools/ninka-1.3/ninka.pl", "-d", file], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    output, err = p.communicate()
+def run_ninka(file, ninka=NINKA, timeout=None):
+    """
+    :return: the raw ninka output, None if ninka did not finish within the timeout (seconds)
+    """
+    # ninka runs its helpers as child processes, they are killed with it as one process group
+    p = Popen([ninka, "-d", file], stdin=PIPE, stdout=PIPE, stderr=PIPE, start_new_session=True)
+    try:
+        output, err = p.communicate(timeout=timeout)
+    except TimeoutExpired:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        p.communicate()
+        return None
     return str(output).strip()
 
 
-def get_file_size(location):
-    filesizes = []
-    """ Get all javascript files in a folder recursively """
-    javafiles = glob2.glob(location + '/**/*.java')
-    for idx, file in enumerate(javafiles):
-        with open(file, 'r') as myfile:
-            size = len(myfile.read().strip().split('\n'))
-            # print(idx, file, size)
-            filesizes.append(size)
+def ninka_license(file, ninka=NINKA, timeout=None):
+    """
+    :return: the license found by ninka, e.g. GPLv2+/Apache-2, 'No license' or None on timeout
+    """
+    output = run_ninka(file, ninka, timeout)
+    if output is None:
+        return None
+    lic = output.split(';')[1].replace('\\n\'', '').replace(',', '/')
+    return lic.replace('NONE', 'No license')
+
+
+def scan_licenses(files, ninka=NINKA, workers=None, timeout=60, cache=None):
+    """
+    Run ninka over the files on a thread pool (each scan is a separate ninka process).
+    Files with the same content are only scanned once.
+    :param files: list of file locations
+    :param workers: no. of ninka processes at the same time, default = no. of CPUs
+    :param timeout: seconds allowed per file
+    :param cache: LicenseCache, files whose content was scanned before are not scanned again
+    :return: list of licenses in the same order as files (None = timed out)
+    """
+    unique = list(dict.fromkeys(files))
+    found = dict()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        digests = dict(zip(unique, executor.map(file_digest, unique)))
+        # group the files by content, a file that cannot be read is a group of its own
+        groups = dict()
+        for f in unique:
+            groups.setdefault(digests[f] or (f,), []).append(f)
+        todo = dict()
+        for digest, group in groups.items():
+            lic = cache.get(digest) if cache is not None and isinstance(digest, str) else None
+            if lic is not None:
+                found.update((f, lic) for f in group)
+            else:
+                todo[digest] = group
+        licenses = executor.map(lambda group: ninka_license(group[0], ninka, timeout), todo.values())
+        for group, lic in zip(todo.values(), licenses):
+            found.update((f, lic) for f in group)
+
+    if cache is not None:
+        for digest, group in todo.items():
+            if found[group[0]] is not None and isinstance(digest, str):
+                cache.put(digest, found[group[0]])
+        cache.commit()
+        print('license cache', cache.stats())
+    print('scanned', len(todo), 'files for', len(files), 'licenses')
+    return [found[f] for f in files]
+
+
+
+def file_digest(file):
+    """
+    :return: sha256 of the file content, None if the file cannot be read
+    """
+    h = hashlib.sha256()
+    try:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
 
-    return filesizes
 
+def ninka_version(ninka=NINKA):
+    """
+    Identify the ninka build by a hash of its script, or by its location if it cannot be read
+    """
+    digest = file_digest(ninka)
+    return digest[:16] if digest is not None else ninka
 
-def create_csv(clones):
+
+class LicenseCache:
+    """
+    Ninka results on disk (SQLite), keyed by the sha256 of the file content and the ninka version
+    """
+
+    def __init__(self, file=LICENSE_CACHE, version=None):
+        self.file = file
+        self.version = version if version is not None else ninka_version()
+        import sqlite3
+        self.conn = sqlite3.connect(file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS licenses ('
+                          'digest TEXT, version TEXT, license TEXT, used REAL, '
+                          'PRIMARY KEY (digest, version))')
+        self.hits = 0
+        self.misses = 0
+        self._used = []
+
+    def get(self, digest):
+        row = self.conn.execute('SELECT license FROM licenses WHERE digest = ? AND version = ?',
+                                (digest, self.version)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.append(digest)
+        return row[0]
+
+    def put(self, digest, lic):
+        self.conn.execute('INSERT OR REPLACE INTO licenses VALUES (?, ?, ?, ?)',
+                          (digest, self.version, lic, time.time()))
+
+    def commit(self):
+        now = time.time()
+        self.conn.executemany('UPDATE licenses SET used = ? WHERE digest = ? AND version = ?',
+                              [(now, digest, self.version) for digest in self._used])
+        self._used = []
+        self.conn.commit()
+
+    def stats(self):
+        entries = self.conn.execute('SELECT COUNT(*) FROM licenses').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def compact(self, max_age_days=None):
+        """
+        Remove the results of other ninka versions and, if max_age_days is given,
+        the results not used for that many days, then shrink the file
+        :return: no. of removed results
+        """
+        removed = self.conn.execute('DELETE FROM licenses WHERE version != ?', (self.version,)).rowcount
+        if max_age_days is not None:
+            removed += self.conn.execute('DELETE FROM licenses WHERE used < ?',
+                                         (time.time() - max_age_days * 86400,)).rowcount
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+        print('removed', removed, 'results from', self.file, self.stats())
+        return removed
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def iter_java_files(location):
+    """ Walk the folder recursively and lazily, yielding every .java file """
+    folders = [location]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith('.java') and entry.is_file():
+                    yield entry.path
+
+
+def count_lines(file, chunk_size=1 << 20):
+    """
+    Count the lines of a file as len(content.strip().split('\\n')) does on the file read in
+    text mode (so \\r\\n and a lone \\r are line breaks too), but on the raw bytes in
+    fixed-size chunks. Only a file that starts or ends with a non-ASCII character is decoded,
+    as str.strip() alone knows which of those are whitespace.
+    """
+    total, leading, trailing = 0, 0, 0
+    in_leading = True
+    first_byte, last_byte = 0, 0
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            # a \r at the end of the chunk is only a line break if no \n follows
+            while chunk.endswith(b'\r'):
+                more = f.read(1)
+                if not more:
+                    break
+                chunk += more
+            text = np.frombuffer(chunk, dtype=np.uint8)
+            newline = text == ord('\n')
+            breaks = newline | (text == ord('\r'))
+            breaks[:-1] &= ~((text[:-1] == ord('\r')) & newline[1:])
+            breaks = np.flatnonzero(breaks)
+            total += len(breaks)
+            kept = np.flatnonzero(~np.isin(text, STRIP_WHITESPACE))
+            if len(kept) == 0:
+                # whitespace only, all of it is leading or (so far) trailing
+                if in_leading:
+                    leading += len(breaks)
+                else:
+                    trailing += len(breaks)
+                continue
+            if in_leading:
+                first_byte = text[kept[0]]
+                leading += int(np.searchsorted(breaks, kept[0]))
+                in_leading = False
+            last_byte = text[kept[-1]]
+            trailing = len(breaks) - int(np.searchsorted(breaks, kept[-1]))
+    if in_leading:
+        return 1
+    if first_byte >= 0x80 or last_byte >= 0x80:
+        with open(file, 'r') as f:
+            return len(f.read().strip().split('\n'))
+    return total - leading - trailing + 1
+
+
+def count_lines_of(files):
+    return [count_lines(file) for file in files]
+
+
+class SizeSummary:
+    """ Summary stats and a histogram (power-of-two buckets) of sizes, updated as they come """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.histogram = Counter()
+
+    def add(self, size):
+        self.count += 1
+        self.total += size
+        self.min = size if self.min is None else min(self.min, size)
+        self.max = size if self.max is None else max(self.max, size)
+        # bucket = the smallest power of two >= size
+        self.histogram[1 << max(size - 1, 0).bit_length()] += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def __str__(self):
+        buckets = ', '.join('<=' + str(b) + ': ' + str(n) for b, n in sorted(self.histogram.items()))
+        return 'files: %d, min: %s, max: %s, mean: %.2f, histogram: %s' % (
+            self.count, self.min, self.max, self.mean(), buckets)
+
+
+def get_file_size(location, workers=None, chunk_size=256):
+    """
+    Get the no. of lines of all java files in a folder recursively
+    :param workers: no. of threads counting lines, default = no. of CPUs
+    :param chunk_size: no. of files per task
+    :return: array of file sizes (lines), SizeSummary of them
+    """
+    filesizes = array('I')
+    summary = SizeSummary()
+    workers = workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded no. of tasks in flight instead of listing the whole corpus first
+        pending = deque()
+        for files in chunks(iter_java_files(location), chunk_size):
+            pending.append(executor.submit(count_lines_of, files))
+            if len(pending) >= 2 * workers:
+                for size in pending.popleft().result():
+                    filesizes.append(size)
+                    summary.add(size)
+        while pending:
+            for size in pending.popleft().result():
+                filesizes.append(size)
+                summary.add(size)
+
+    return filesizes, summary
+
+
+def create_csv(clones, file_name="clones.csv", compress=False, workers=1):
     columns = ['file1', 'start1', 'end1', 'file2', 'start2', 'end2', 'classification', 'notes']
-    write_clones_to_file(clones, columns, "clones.csv", print_header=True, quote_on=True)
+    write_clones_to_file(clones, columns, file_name, print_header=True, quote_on=True,
+                         compress=compress, workers=workers)
 
 
 def stats(data):
@@ -483,9 +1935,118 @@ def stats(data):
 
 
 def get_sizes(data):
+    if isinstance(data, ClonePairTable):
+        return data.sizes().tolist()
     return [d['end1'] - d['start1'] + 1 for d in data]
 
 
+def figure_digest(spec):
+    """ :return: hash of everything a figure is drawn from: the whole spec and the code drawing it """
+    return hashlib.sha1((json.dumps(spec, sort_keys=True) + code_version(render_figure)).encode('utf-8')).hexdigest()
+
+
+def render_figure(spec):
+    """
+    Draw one figure spec to its PDF on the non-interactive Agg/PDF backend.
+    Runs in a worker process, so every figure starts from the default rc settings
+    and is closed once saved.
+    :param spec: dict with 'kind' ('boxplot' or 'bar'), 'file' and the data/options of the kind
+    :return: the PDF file
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.rcdefaults()
+    if spec['kind'] == 'bar':
+        matplotlib.rcParams.update({'font.size': 16})
+        fig, ax = plt.subplots()
+    else:
+        fig = plt.figure()
+        ax = fig.gca()
+    try:
+        if spec['kind'] == 'bar':
+            y_pos = np.arange(len(spec['keys']))
+            ax.bar(y_pos, spec['values'], align='center')
+            ax.set_xticks(y_pos)
+            ax.set_xticklabels(spec['keys'])
+            ax.set_ylabel(spec['ylabel'])
+            if 'yticks' in spec:
+                ax.set_yticks(np.arange(*spec['yticks']))
+            plt.setp(ax.get_xticklabels(), rotation=30, ha='right')
+            fig.tight_layout()
+            fig.set_size_inches(*spec['size'])
+            fig.savefig(spec['file'], format='pdf')
+        else:
+            ax.boxplot(spec['data'], vert=spec.get('vert', True))
+            if 'xlabel' in spec:
+                ax.set_xlabel(spec['xlabel'])
+            if 'ylabel' in spec:
+                ax.set_ylabel(spec['ylabel'])
+            if 'xticks' in spec:
+                ax.set_xticks(spec['xticks'][0])
+                ax.set_xticklabels(spec['xticks'][1])
+            if 'xlim' in spec:
+                ax.set_xlim(*spec['xlim'])
+            if not spec.get('vert', True):
+                ax.tick_params(axis='y', which='both', left=False, right=False, labelleft=False)
+            if 'size' in spec:
+                fig.set_size_inches(*spec['size'])
+            fig.savefig(spec['file'], bbox_inches='tight')
+    finally:
+        plt.close(fig)
+    return spec['file']
+
+
+def render_figures(specs, workers=None):
+    """
+    Render figure specs to PDFs in parallel worker processes. A PDF is skipped when
+    it exists and the digest of its spec (stored next to it as <file>.sha1) is unchanged.
+    :param specs: list of figure specs (see render_figure)
+    :param workers: no. of worker processes, default = one per figure (up to the no. of CPUs)
+    :return: list of the PDF files rendered
+    """
+    todo = []
+    for spec in specs:
+        digest = figure_digest(spec)
+        try:
+            with open(spec['file'] + '.sha1') as f:
+                if os.path.exists(spec['file']) and f.read().strip() == digest:
+                    print('skipped', spec['file'], '(unchanged)')
+                    continue
+        except FileNotFoundError:
+            pass
+        todo.append((spec, digest))
+    if not todo:
+        return []
+
+    workers = workers or min(len(todo), os.cpu_count() or 1)
+    if workers > 1 and len(todo) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            files = list(executor.map(render_figure, [spec for spec, _ in todo]))
+    else:
+        files = [render_figure(spec) for spec, _ in todo]
+    for spec, digest in todo:
+        with open(spec['file'] + '.sha1', 'w') as f:
+            f.write(digest + '\n')
+    return files
+
+
+def boxplot_spec(data1, data2, data3, data4, data5, data6):
+    """
+    Figure spec of a boxplot of clone size per classification (see render_figures)
+    :param data1: clones#1 (QS)
+    :param data2: clones#2 (SQ)
+    :param data3: clones#3 (UD)
+    :param data4: clones#4 (EX)
+    :param data5: clones#5 (BP)
+    :param data6: clones#6 (IN)
+    """
+    data = [get_sizes(clones) for clones in [data1, data2, data3, data4, data5, data6]]
+    return {'kind': 'boxplot', 'file': 'boxplot_clone_size.pdf', 'data': data,
+            'ylabel': 'no. of lines', 'xticks': [[1, 2, 3, 4, 5, 6], ['QS', 'SQ', 'UD', 'EX', 'BP', 'IN']]}
+
+
 def boxplot(data1, data2, data3, data4, data5, data6):
     """
     Plot a boxplot of clone size (QS, UD, EX)
@@ -494,19 +2055,18 @@ def boxplot(data1, data2, data3, data4, data5, data6):
     :param data3: clones#3 (EX)
     :return: N/A
     """
-    size1 = get_sizes(data1)
-    size2 = get_sizes(data2)
-    size3 = get_sizes(data3)
-    size4 = get_sizes(data4)
-    size5 = get_sizes(data5)
-    size6 = get_sizes(data6)
-    data = [size1, size2, size3, size4, size5, size6]
-    plt.figure()
-    plt.boxplot(data)
-    # plt.ylim(10)
-    plt.ylabel('no. of lines')
-    plt.xticks([1, 2, 3, 4, 5, 6], ['QS', 'SQ', 'UD', 'EX', 'BP', 'IN'])
-    plt.savefig('boxplot_clone_size.pdf', bbox_inches='tight')
+    render_figures([boxplot_spec(data1, data2, data3, data4, data5, data6)])
+
+
+def boxplot_combined_spec(data1, data2, data3, data4, data5, data6):
+    """
+    Figure spec of a single boxplot of clone size over all the given clones (see render_figures)
+    """
+    size = []
+    for clones in [data1, data2, data3, data4, data5, data6]:
+        size += get_sizes(clones)
+    return {'kind': 'boxplot', 'file': 'boxplot_clone_size_combined.pdf', 'data': [size], 'vert': False,
+            'xlabel': 'no. of lines', 'xlim': [0, 140], 'size': [7, 2]}
 
 
 def boxplot_combined(data1, data2, data3, data4, data5, data6):
@@ -518,93 +2078,103 @@ def boxplot_combined(data1, data2, data3, data4, data5, data6):
     :param data4: clones#4 (EX)
     :return: N/A
     """
-    combined = data1 + data2 + data3 + data4 + data5 + data6
-    size = get_sizes(combined)
-    data = [size]
-    fig = plt.figure()
-    plt.boxplot(data, vert=False)
-    # plt.ylim(10)
-    plt.xlabel('no. of lines')
-    plt.xlim(0, 140)
-    plt.tick_params(
-        axis='y',  # changes apply to the x-axis
-        which='both',  # both major and minor ticks are affected
-        left=False,  # ticks along the bottom edge are off
-        right=False,  # ticks along the top edge are off
-        labelleft=False)  # labels along the bottom edge are off
-    fig.set_size_inches(7, 2)
-    plt.savefig('boxplot_clone_size_combined.pdf', bbox_inches='tight')
-
-
-def write_outdated_clones_to_file(outdated_clones):
-    metadata = ''
-    # write all the outdated snippets to files
-    for i, oc in enumerate(outdated_clones):
-        lines = oc['code1'].split('\n')
-        # print(oc['file1'], oc['start1'], oc['end1'])
-        code = '\n'.join(lines[int(oc['start1']) - 1: int(oc['end1'])])
-        # print(oc)
-        # print_a_clone(oc, ['file1', 'code1'], print_header=False)
-        metadata += str(i + 1) + '_' + oc['file1'] + ',' + str(oc['start1']) + ',' + str(oc['end1']) + ','
-        metadata += oc['file2'] + ',' + str(oc['start2']) + ',' + str(oc['end2']) + '\n'
-        write_file(
-            '/Users/Chaiyong/Downloads/stackoverflow/stackoverflow_outdated_snippets/' + str(i + 1) + '_' + oc['file1'],
-            code, 'w', False)
-    write_file('outdated_metadata.csv', metadata, 'w', False)
+    render_figures([boxplot_combined_spec(data1, data2, data3, data4, data5, data6)])
+
+
+OUTDATED_ROOT = os.environ.get('OUTDATED_ROOT', '/Users/Chaiyong/Downloads/stackoverflow/stackoverflow_outdated_snippets/')
+
+
+def extract_snippet(clone):
+    """ :return: the cloned lines (start1 to end1) of code1 """
+    return clone_lines(clone, 1).text(int(clone['start1']), int(clone['end1']))
+
+
+def write_outdated_clones_to_file(outdated_clones, output_root=OUTDATED_ROOT, archive=True, workers=None,
+                                  metadata_file='outdated_metadata.csv'):
+    """
+    Write the outdated snippets and a metadata CSV (snippet, start1, end1, file2, start2, end2)
+    :param output_root: folder of the snippets
+    :param archive: write all the snippets into output_root/outdated_snippets.zip
+        (the zip central directory indexes them), otherwise one file per snippet
+    :param workers: no. of threads extracting (and, without archive, writing) the snippets
+    :return: N/A
+    """
+    os.makedirs(output_root, exist_ok=True)
+    names = [str(i + 1) + '_' + oc['file1'] for i, oc in enumerate(outdated_clones)]
+
+    def write_snippet(name, clone):
+        write_file(os.path.join(output_root, name), extract_snippet(clone), 'w', False)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            open(metadata_file, 'w', newline='') as mf:
+        metadata = csv.writer(mf, lineterminator='\n')
+        if archive:
+            import zipfile
+            # the zip file is written by this thread only, the pool extracts the snippets
+            with zipfile.ZipFile(os.path.join(output_root, 'outdated_snippets.zip'), 'w',
+                                 zipfile.ZIP_DEFLATED) as zf:
+                for name, oc, code in zip(names, outdated_clones, executor.map(extract_snippet, outdated_clones)):
+                    zf.writestr(name, code)
+                    metadata.writerow([name, oc['start1'], oc['end1'], oc['file2'], oc['start2'], oc['end2']])
+        else:
+            for name, oc, _ in zip(names, outdated_clones, executor.map(write_snippet, names, outdated_clones)):
+                metadata.writerow([name, oc['start1'], oc['end1'], oc['file2'], oc['start2'], oc['end2']])
 
 
 def count_od_comment_outdated(outdated_clones):
-    count = [0, 0, 0]
-    changed = 0
-    for idx, odc in enumerate(outdated_clones):
-        if odc['od_comment_outdated'] == 'Yes' or odc['od_comment_outdated'] == 'Maybe':
-            count[0] += 1
-            if odc['od_changed_outdated_code'] == 'Yes':
-                changed += 1
-        elif odc['od_comment_outdated'] == 'No':
-            count[1] += 1
-        elif odc['od_comment_outdated'] == 'Not found':
-            count[2] += 1
-    return count, changed
+    counts = count_outdated_pairs(outdated_clones)
+    return counts['comment_count'], counts['changed']
 
 
 def count_newer_higher_votes(outdated_clones):
-    newer_count = 0
-    higher_vote_count = [0, 0]
-    for idx, odc in enumerate(outdated_clones):
-        if 'Yes' in odc['od_newer_answer']:
-            newer_count += 1
-        if 'Yes' in odc['od_higher-voted_answers']:
-            higher_vote_count[0] += 1
-        elif 'Equal' in odc['od_higher-voted_answers']:
-            higher_vote_count[1] += 1
-    return newer_count, higher_vote_count
+    counts = count_outdated_pairs(outdated_clones)
+    return counts['newer'], counts['higher_votes']
+
+
+@lru_cache(maxsize=None)
+def parse_so_date(date):
+    """ parse a dd-Mon-yy date (e.g. 22-Jan-13) once, as a numpy datetime64 day """
+    return np.datetime64(datetime.strptime(date, '%d-%b-%y').date(), 'D')
+
+
+def month_diff(later, earlier):
+    """
+    Whole months between two arrays of dates, counted as relativedelta does
+    (a month ends on the same day of the month, or the last day if it is shorter).
+    Negative differences become 0.
+    """
+    earlier_month = earlier.astype('datetime64[M]')
+    months = (later.astype('datetime64[M]') - earlier_month).astype(np.int64)
+    day = (earlier - earlier_month.astype('datetime64[D]')).astype(np.int64)
+    target = earlier_month + months
+    month_len = ((target + 1).astype('datetime64[D]') - target.astype('datetime64[D]')).astype(np.int64)
+    shifted = target.astype('datetime64[D]') + np.minimum(day, month_len - 1)
+    months -= shifted > later
+    return np.maximum(months, 0)
+
+
+def clone_ages(clones, type, ref_dates):
+    """
+    Age of the SO answers of the clones, relative to the release date of their Qualitas project
+    :param type: 'days' or 'months'
+    :param ref_dates: dict of project -> release date (dd-Mon-yy)
+    :return: numpy array of ages, clones without an answer post date are skipped
+    """
+    if type not in ('days', 'months'):
+        print('Error: wrong clone age type (days or months).')
+        exit()
+    refs = {proj: parse_so_date(date) for proj, date in ref_dates.items()}
+    dated = [odc for odc in clones if odc['od_answer_post_date'] != 'None']
+    posted = np.array([parse_so_date(odc['od_answer_post_date'].split(' ')[0]) for odc in dated],
+                      dtype='datetime64[D]')
+    released = np.array([refs[odc['file2'].split('/')[0]] for odc in dated], dtype='datetime64[D]')
+    if type == 'days':
+        return (posted - released).astype(np.int64)
+    return month_diff(posted, released)
 
 
 def get_clone_ages(clones, type, ref_dates):
-    data = list()
-    for idx, odc in enumerate(clones):
-        if odc['od_answer_post_date'] != 'None':
-            postdate = odc['od_answer_post_date'].split(' ')[0]
-            d = datetime.strptime(postdate, '%d-%b-%y')
-            proj_name = odc['file2'].split('/')[0]
-            ref_d = datetime.strptime(ref_dates[proj_name], '%d-%b-%y')
-            # exit()
-            if type == 'days':
-                delta = d - ref_d
-                data.append(delta.days)
-            elif type == 'months':
-                r = relativedelta.relativedelta(d, ref_d)
-                if r.years < 0:
-                    r.years = 0
-                if r.months < 0:
-                    r.months = 0
-                # print(d, ref_d, r.years, r.months)
-                data.append(r.years * 12 + r.months)
-            else:
-                print('Error: wrong clone age type (days or months).')
-                exit()
-    return data
+    return clone_ages(clones, type, ref_dates).tolist()
 
 
 def get_qs_ref_dates():
@@ -641,8 +2211,10 @@ def get_qs_ref_dates():
     return ref_dates
 
 
-def boxplot_post_age(clone_set, names):
-    plt.figure()
+def boxplot_post_age_spec(clone_set, names):
+    """
+    Print the clone age stats and return the figure spec of their boxplot (see render_figures)
+    """
     type = 'months'
     ref_dates = get_qs_ref_dates()
     data = list()
@@ -654,31 +2226,93 @@ def boxplot_post_age(clone_set, names):
         print(name, end=' & ')
         stats(data[idx])
 
-    fig = plt.figure()
-    plt.boxplot(data, vert=False)
     # plt.xticks(range(1, len(names) + 1), names)
-    plt.xlabel('age of clones (' + type + ')')
-    plt.tick_params(
-        axis='y',  # changes apply to the x-axis
-        which='both',  # both major and minor ticks are affected
-        left=False,  # ticks along the bottom edge are off
-        right=False,  # ticks along the top edge are off
-        labelleft=False)  # labels along the bottom edge are off
-    fig.set_size_inches(7, 2)
-    plt.savefig('boxplot_clone_age.pdf', bbox_inches='tight')
+    return {'kind': 'boxplot', 'file': 'boxplot_clone_age.pdf', 'data': data, 'vert': False,
+            'xlabel': 'age of clones (' + type + ')', 'size': [7, 2]}
+
+
+def boxplot_post_age(clone_set, names):
+    render_figures([boxplot_post_age_spec(clone_set, names)])
 
 
 def count_outdated_reason(outdated_clones):
-    reasons = dict()
-    for idx, odc in enumerate(outdated_clones):
-        r = odc['od_reason_change']
-        if r not in reasons:
-            reasons[r] = 1
-        else:
-            reasons[r] = reasons[r] + 1
-        # if r == 'bug':
-        #     print(odc['file1'])
-    return reasons
+    return count_outdated_pairs(outdated_clones)['reasons']
+
+
+OutdatedReport = namedtuple('OutdatedReport', [
+    'outdated',  # outdated clone pairs
+    'comment_count',  # outdated pairs with an outdated comment [yes or maybe, no, not found]
+    'changed',  # pairs with an outdated comment whose code was changed
+    'newer',  # pairs with a newer answer
+    'higher_votes',  # pairs with higher-voted answers [yes, equal]
+    'reasons',  # intent of the change -> no. of pairs
+    'mod_types',  # modification type -> total over all the pairs (get_code_mod_types)
+    'issues',  # outdated pairs whose latest note refers to an issue (@...)
+    'projects',  # Qualitas projects of the outdated pairs, first-seen order
+    'pcount',  # no. of outdated pairs per project
+    'short_projects'  # short project name -> no. of outdated pairs (get_projects_having_outdated_clones)
+])
+
+
+def new_outdated_counts():
+    return {'comment_count': [0, 0, 0], 'changed': 0, 'newer': 0, 'higher_votes': [0, 0], 'reasons': dict()}
+
+
+def count_outdated_pair(counts, clone):
+    """
+    Add an outdated clone pair to the RQ3 counters
+    :param counts: the counters, from new_outdated_counts
+    """
+    comment = clone['od_comment_outdated']
+    if comment == 'Yes' or comment == 'Maybe':
+        counts['comment_count'][0] += 1
+        if clone['od_changed_outdated_code'] == 'Yes':
+            counts['changed'] += 1
+    elif comment == 'No':
+        counts['comment_count'][1] += 1
+    elif comment == 'Not found':
+        counts['comment_count'][2] += 1
+    if 'Yes' in clone['od_newer_answer']:
+        counts['newer'] += 1
+    if 'Yes' in clone['od_higher-voted_answers']:
+        counts['higher_votes'][0] += 1
+    elif 'Equal' in clone['od_higher-voted_answers']:
+        counts['higher_votes'][1] += 1
+    reasons = counts['reasons']
+    reasons[clone['od_reason_change']] = reasons.get(clone['od_reason_change'], 0) + 1
+
+
+def count_outdated_pairs(outdated_clones):
+    """ :return: the RQ3 counters of the clone pairs, every one of them is counted as outdated """
+    counts = new_outdated_counts()
+    for clone in outdated_clones:
+        count_outdated_pair(counts, clone)
+    return counts
+
+
+def outdated_analytics(clones):
+    """
+    Compute all the RQ3 counters in one pass over the clone pairs
+    :return: OutdatedReport
+    """
+    outdated, issues = [], []
+    counts = new_outdated_counts()
+    mod_types = dict.fromkeys(MOD_TYPE_COLUMNS, 0)
+    for clone in clones:
+        for column in MOD_TYPE_COLUMNS:
+            mod_types[column] += int(clone.get(column, 0))
+        if clone["latest_ischanged"] != "true":
+            continue
+        outdated.append(clone)
+        count_outdated_pair(counts, clone)
+        if clone["latest_note"].startswith("@"):
+            issues.append(clone)
+
+    projects = count_projects(outdated)
+    short_projects = count_projects(outdated, formatted=True)
+    return OutdatedReport(outdated, counts['comment_count'], counts['changed'], counts['newer'],
+                          counts['higher_votes'], counts['reasons'], mod_types, issues,
+                          list(projects), list(projects.values()), short_projects)
 
 
 def print_no_date_clones(clones):
@@ -689,31 +2323,251 @@ def print_no_date_clones(clones):
             print(idx, c['file1'], 'Missing')
 
 
-def main():
+LICENSE_CLASSIFICATIONS = ['QS', 'EX', 'UD']
 
-    # TODO: uncomment this if you want to find median or any stats about SO snippets
-    # filesizes = get_file_size('/Users/Chaiyong/Downloads/stackoverflow/stackoverflow_formatted')
-    # median = statistics.median(filesizes)
-    # print('median file size of ' + str(len(filesizes)) + ' = ' + str(median))
 
-    print("A Python script for processing data for Cloverflow study.")
+def classification_analytics(classification, table, urows, rows, usnippet_rows):
+    """
+    Statistics of the clone pairs of one classification
+    :param table: ClonePairTable of the snapshot
+    :param urows, rows, usnippet_rows: snapshot rows of the unique pairs, all pairs and unique snippets
+    :return: dict with the rows, the clone sizes, the Qualitas projects of all and of the unique pairs
+        and the license counts
+    """
+    analytics = {
+        'rows': (list(urows), list(rows), list(usnippet_rows)),
+        'sizes': get_sizes(table.take(np.asarray(rows, dtype=np.int64))),
+        'projects': get_qproject(table.take(np.asarray(rows, dtype=np.int64))),
+        'uprojects': get_qproject(table.take(np.asarray(urows, dtype=np.int64))),
+        'licenses': None
+    }
+    if classification in LICENSE_CLASSIFICATIONS:
+        # count_licenses over the license columns, in first-seen order
+        usnippets = table.take(np.asarray(usnippet_rows, dtype=np.int64))
+        column1, column2 = license_columns(classification)
+        analytics['licenses'] = Counter(license1 + " & " + license2 for license1, license2
+                                        in zip(usnippets.labels(column1), usnippets.labels(column2)))
+    return analytics
+
+
+def analyse_classification(snapshot_file, classification):
+    """
+    Process pool worker of analyse_classifications. It maps the snapshot itself and partitions
+    and dedups the pairs on its fixed-width columns, so the pairs are shared through the page
+    cache and no pair metadata is decoded.
+    """
+    snapshot = Snapshot(snapshot_file)
+    table = snapshot.table()
+    if 'snippet' not in table.columns:
+        # a snapshot written before the snippet column: dedup the decoded pairs
+        clones = snapshot.clones()
+        rows = np.flatnonzero(table.mask('classification', classification)).tolist()
+        uclones, allclones = dedup([clones[row] for row in rows], clone_key)
+        usnippets, _ = dedup(allclones, snippet_key)
+        return classification_analytics(classification, table, *([c.row for c in group]
+                                                                  for group in (uclones, allclones, usnippets)))
+    rows = np.flatnonzero(table.mask('classification', classification))
+    pairs = table.take(rows)
+    urows = rows[pairs.first_rows('snippet', 'start1', 'end1')]
+    usnippet_rows = rows[pairs.first_rows('snippet')]
+    return classification_analytics(classification, table, urows.tolist(), rows.tolist(), usnippet_rows.tolist())
+
+
+def analyse_classifications(snapshot, clones, jobs=1):
+    """
+    Run classification_analytics for every classification, in one pass over the clones
+    or, with jobs > 1, one classification per task on a process pool
+    :return: dict of classification -> analytics, in first-seen order of the classifications
+    """
+    table = snapshot.table()
+    if jobs <= 1:
+        return {classification: classification_analytics(classification, table,
+                                                         *([c.row for c in group] for group in partition))
+                for classification, partition in partition_clones(clones, "classification").items()}
+    classifications = table.categories['classification']
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(classifications, executor.map(analyse_classification,
+                                                      [snapshot.file] * len(classifications), classifications)))
+
+
+STAGES = OrderedDict()
+
+
+def stage(*inputs, cache=False, params=()):
+    """
+    Register a pipeline stage. The stage is called as fn(results, args), where results
+    holds the results of the stages it declares as inputs.
+    :param inputs: names of the stages whose results the stage reads
+    :param cache: keep the result on disk (see StageCache), for stages that only compute
+    :param params: names of the command line options the result depends on (part of the cache key)
+    """
+    def register(fn):
+        STAGES[fn.__name__[len('stage_'):]] = (fn, inputs, cache, params)
+        return fn
+    return register
+
+
+STAGE_CACHE_DIR = '.stage_cache'
+
+
+@lru_cache(maxsize=None)
+def module_definitions():
+    """
+    Parse this module once per process
+    :return: dict of top-level name -> (source of its definition with decorators, names the definition uses)
+    """
+    import ast
+    source = Path(__file__).read_text(encoding='utf-8')
+    lines = source.splitlines(keepends=True)
+    definitions = dict()
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = [n.id for target in targets for n in ast.walk(target) if isinstance(n, ast.Name)]
+        else:
+            continue
+        # top-level statements span whole lines, the decorators come first
+        first = min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+        text = ''.join(lines[first - 1:node.end_lineno])
+        used = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+        for name in names:
+            old_text, old_used = definitions.get(name, ('', set()))
+            definitions[name] = (old_text + text, old_used | used)
+    return definitions
+
+
+def code_version(fn):
+    """
+    Hash of the source of a function (or class) and, transitively, of the functions, classes
+    and constants of this module it refers to, so the hash changes when any of them changes
+    """
+    return definition_version(fn.__name__)
+
+
+@lru_cache(maxsize=None)
+def definition_version(name):
+    definitions = module_definitions()
+    closure, todo = set(), [name]
+    while todo:
+        name = todo.pop()
+        if name not in closure and name in definitions:
+            closure.add(name)
+            todo.extend(definitions[name][1])
+    h = hashlib.sha1()
+    for name in sorted(closure):
+        h.update((name + '\0' + definitions[name][0] + '\0').encode('utf-8'))
+    return h.hexdigest()
+
+
+class StageCache:
+    """
+    Results of the computing stages on disk, keyed by the snapshot digest, the code version
+    of the stage, its options and the keys of its inputs. Clone pairs are stored as their snapshot rows
+    and namedtuples by the name of their type, so the cache does not depend on the module path
+    (__main__ or qs_clone_processor) that wrote it.
+    """
+
+    def __init__(self, snapshot, args=None, folder=STAGE_CACHE_DIR):
+        self.snapshot = snapshot
+        self.args = args
+        self.folder = folder
+        self.keys = dict()
+
+    def key(self, name):
+        if name not in self.keys:
+            fn, inputs, _, params = STAGES[name]
+            h = hashlib.sha1((self.snapshot.digest + code_version(fn)).encode('utf-8'))
+            for param in params:
+                h.update(repr(getattr(self.args, param, None)).encode('utf-8'))
+            for input_name in inputs:
+                h.update(self.key(input_name).encode('utf-8'))
+            self.keys[name] = h.hexdigest()[:16]
+        return self.keys[name]
+
+    def file(self, name):
+        return os.path.join(self.folder, name + '-' + self.key(name) + '.pickle')
+
+    def load(self, name):
+        """ :return: (True, result) if the result is cached, else (False, None) """
+        try:
+            with open(self.file(name), 'rb') as f:
+                return True, self.decode(pickle.load(f))
+        except FileNotFoundError:
+            return False, None
+        except Exception as e:
+            # unreadable (e.g. written by an older layout): recompute it
+            print('ignored cached', name, 'from', self.file(name) + ':', repr(e))
+            return False, None
+
+    def save(self, name, result):
+        os.makedirs(self.folder, exist_ok=True)
+        # drop the results of older snapshots or code versions of the stage
+        for old in os.listdir(self.folder):
+            if old.startswith(name + '-'):
+                os.remove(os.path.join(self.folder, old))
+        with open(self.file(name) + '.tmp', 'wb') as f:
+            pickle.dump(self.encode(result), f)
+        os.replace(self.file(name) + '.tmp', self.file(name))
+
+    def encode(self, value):
+        if isinstance(value, list) and all(isinstance(v, SnapshotClone) for v in value):
+            return {'__rows__': np.array([v.row for v in value], dtype=np.int64)}
+        if isinstance(value, tuple) and hasattr(value, '_fields'):
+            return {'__namedtuple__': type(value).__name__, 'values': [self.encode(v) for v in value]}
+        if isinstance(value, tuple):
+            return tuple(self.encode(v) for v in value)
+        if type(value) is dict:
+            return {k: self.encode(v) for k, v in value.items()}
+        return value
+
+    def decode(self, value):
+        if isinstance(value, dict) and '__rows__' in value:
+            clones = self.snapshot.clones()
+            return [clones[row] for row in value['__rows__'].tolist()]
+        if isinstance(value, dict) and '__namedtuple__' in value:
+            return globals()[value['__namedtuple__']](*(self.decode(v) for v in value['values']))
+        if isinstance(value, tuple):
+            return tuple(self.decode(v) for v in value)
+        if type(value) is dict:
+            return {k: self.decode(v) for k, v in value.items()}
+        return value
+
+
+@stage()
+def stage_download(results, args):
     # copied from
     # https://stackoverflow.com/questions/82831/how-do-i-check-whether-a-file-exists-using-python?page=1&tab=votes#tab-top
     filename = "allclones.list"
-    clonefile = Path(filename)
-
-    if not clonefile.exists():
-        # download clones
-        print("Clone data does not exist. Downloading from the db ...")
-        allclones = download_clones()
-        write_list_to_file(allclones, filename)
-    else:
-        allclones = read_list_from_file("allclones.list")
-
-    allclones = clean(allclones)
+    clonefile = Path(SNAPSHOT_FILE)
+
+    if args.full_sync:
+        print("Downloading all the clone pairs from the db ...")
+        write_snapshot(download_clones(chunked=True), SNAPSHOT_FILE)
+        shutil.rmtree(SHARD_DIR, ignore_errors=True)
+    elif clonefile.exists() and args.sync:
+        sync_clones(SNAPSHOT_FILE)
+    elif not clonefile.exists():
+        if Path(filename).exists():
+            print("Converting " + filename + " to a snapshot ...")
+            convert_list_to_snapshot(filename, SNAPSHOT_FILE)
+        else:
+            # download clones
+            print("Clone data does not exist. Downloading from the db ...")
+            write_snapshot(download_clones(chunked=True), SNAPSHOT_FILE)
+            shutil.rmtree(SHARD_DIR, ignore_errors=True)
+    snapshot = Snapshot(SNAPSHOT_FILE)
+    print('snapshot downloaded at', datetime.fromtimestamp(snapshot.downloaded).strftime('%Y-%m-%d %H:%M:%S'))
+    return snapshot
+
+
+@stage('download')
+def stage_clean(results, args):
+    snapshot = results['download']
+    allclones = clean(snapshot.clones())
     print('total clone pairs after removing nulls:', len(allclones))
-    # print all the clones to a csv file
-    create_csv(allclones)
 
     # TODO: Uncomment this if you want to see any specific clone pair(s)
     # for i, clone in enumerate(allclones):
@@ -721,55 +2575,98 @@ def main():
     #         columns = [ 'file1', 'latest_file', 'latest_change_date', 'latest_note', 'code1_license' ]
     #         print(i)
     #         print_a_clone(clone, columns)
+    return allclones, snapshot.table()
+
+
+@stage('clean')
+def stage_export(results, args):
+    allclones, _ = results['clean']
+    # print all the clones to a csv file
+    create_csv(allclones)
 
-    print('-' * 60)
-    # print('no. of all clone pairs in the db', len(allclones))
 
+@stage('download', 'clean', cache=True)
+def stage_analytics(results, args):
+    allclones, _ = results['clean']
     # get 7 patterns online clone statistics
-    filter = "classification"
-    classification = "QS"
-    qs_uclones, qs_clones = get_unique_so_clones_with_filter(allclones, filter, classification)
-    qs_usnippets = get_unique_so_snippets_with_filter(allclones, filter, classification)
-    classification = "SQ"
-    sq_uclones, sq_clones = get_unique_so_clones_with_filter(allclones, filter, classification)
-    sq_usnippets = get_unique_so_snippets_with_filter(allclones, filter, classification)
-    classification = "EX"
-    ex_uclones, ex_clones = get_unique_so_clones_with_filter(allclones, filter, classification)
-    ex_usnippets = get_unique_so_snippets_with_filter(allclones, filter, classification)
-    classification = "UD"
-    ud_uclones, ud_clones = get_unique_so_clones_with_filter(allclones, filter, classification)
-    ud_usnippets = get_unique_so_snippets_with_filter(allclones, filter, classification)
-    classification = "BP"
-    bp_uclones, bp_clones = get_unique_so_clones_with_filter(allclones, filter, classification)
-    bp_usnippets = get_unique_so_snippets_with_filter(allclones, filter, classification)
-    classification = "IN"
-    in_uclones, in_clones = get_unique_so_clones_with_filter(allclones, filter, classification)
-    in_usnippets = get_unique_so_snippets_with_filter(allclones, filter, classification)
-    classification = "AC"
-    ac_uclones, ac_clones = get_unique_so_clones_with_filter(allclones, filter, classification)
-    ac_usnippets = get_unique_so_snippets_with_filter(allclones, filter, classification)
+    return analyse_classifications(results['download'], allclones, args.jobs)
+
 
+@stage('clean', 'analytics')
+def stage_partition(results, args):
+    allclones, _ = results['clean']
+    return {classification: tuple([allclones[row] for row in rows] for rows in analytics['rows'])
+            for classification, analytics in results['analytics'].items()}
+
+
+@stage('clean', 'partition', cache=True, params=('similarity', 'num_perm', 'shingle_size'))
+def stage_clusters(results, args):
+    """
+    Near-duplicate clusters (cluster_near_duplicates) of the cloned lines of code1
+    of the unique snippets and of the unique tp snippets
+    """
+    allclones, _ = results['clean']
+    partitions = results['partition']
+    u_snippets, _ = get_unique_so_snippets(allclones)
+    tp_snippets = [snippet for c in ['QS', 'SQ', 'EX', 'UD', 'BP', 'IN']
+                   for snippet in get_partition(partitions, c)[2]]
+    clusters = dict()
+    for name, snippets in [('snippets', u_snippets), ('tp snippets', tp_snippets)]:
+        clusters[name] = cluster_near_duplicates((extract_snippet(snippet) for snippet in snippets),
+                                                 args.similarity, args.num_perm, args.shingle_size)
+    return clusters
+
+
+@stage('clean', 'partition', 'clusters')
+def stage_rq1(results, args):
+    allclones, table = results['clean']
+    partitions = results['partition']
+    qs_uclones, qs_clones, qs_usnippets = get_partition(partitions, "QS")
+    sq_uclones, sq_clones, sq_usnippets = get_partition(partitions, "SQ")
+    ex_uclones, ex_clones, ex_usnippets = get_partition(partitions, "EX")
+    ud_uclones, ud_clones, ud_usnippets = get_partition(partitions, "UD")
+    bp_uclones, bp_clones, bp_usnippets = get_partition(partitions, "BP")
+    in_uclones, in_clones, in_usnippets = get_partition(partitions, "IN")
+
+    print('-' * 60)
     print("RQ1:")
     print('total clones', len(allclones))
     uclones = get_unique_so_clones(allclones)
     print('total unique clones', len(uclones))
     u_snippets, _ = get_unique_so_snippets(allclones)
     print('total unique snippets', len(u_snippets))
-    projects, _ = get_qproject(u_snippets)
+    print('near-duplicate clusters of unique snippets (all/2+ snippets/snippets in them)',
+          *cluster_counts(results['clusters']['snippets']))
+    projects, _ = get_qproject(table.subset(u_snippets))
     print('qualitas projects', len(projects))
-    print('avg. clone ratio', get_avg_clone_ratio(uclones, 1))
+    print('avg. clone ratio', get_avg_clone_ratio(table.subset(uclones), 1))
     tp_clones = qs_clones + sq_clones + ex_clones + ud_clones + bp_clones + in_clones
     print('total tp clones', len(tp_clones))
     utp = qs_uclones + sq_uclones + ex_uclones + ud_uclones + bp_uclones + in_uclones
     print('total unique tp clones', len(utp))
     tp_snippets = qs_usnippets + sq_usnippets + ex_usnippets + ud_usnippets + bp_usnippets + in_usnippets
     print('total unique tp snippets', len(tp_snippets))
-    projects, pcount = get_qproject(utp)
+    print('near-duplicate clusters of unique tp snippets (all/2+ snippets/snippets in them)',
+          *cluster_counts(results['clusters']['tp snippets']))
+    projects, pcount = get_qproject(table.subset(utp))
     print('qualitas projects', len(projects))
-    print('avg. clone ratio', get_avg_clone_ratio(utp, 1))
+    print('avg. clone ratio', get_avg_clone_ratio(table.subset(utp), 1))
     print()
     print('-' * 60)
 
+
+@stage('partition', 'analytics')
+def stage_rq2(results, args):
+    partitions = results['partition']
+    analytics = results['analytics']
+    qs_uclones, qs_clones, _ = get_partition(partitions, "QS")
+    sq_uclones, sq_clones, _ = get_partition(partitions, "SQ")
+    ex_uclones, ex_clones, _ = get_partition(partitions, "EX")
+    ud_uclones, ud_clones, _ = get_partition(partitions, "UD")
+    bp_uclones, bp_clones, _ = get_partition(partitions, "BP")
+    in_uclones, in_clones, _ = get_partition(partitions, "IN")
+    ac_uclones, ac_clones, _ = get_partition(partitions, "AC")
+
     print("RQ2:")
     print('no. of SO clones (QS)', len(qs_uclones), '/', len(qs_clones))
     # print('no. of unique SO snippets (' + classification + ')', len(qs_uclones))
@@ -780,9 +2677,9 @@ def main():
     print('no. of SO clones (IN)', len(in_uclones), '/', len(in_clones))
     print('no. of SO clones (AC)', len(ac_uclones), '/', len(ac_clones))
 
-    projects, pcount = get_qproject(qs_clones)
+    projects, pcount = analytics['QS']['projects']
     print('qualitas projects', len(projects))
-    projects, pcount = get_qproject(qs_uclones)
+    projects, pcount = analytics['QS']['uprojects']
     print('qualitas projects unique', len(projects))
 
     # TODO: UNCOMMENT IF LATEX TABLE OF 'QS GROUPED BY PROJECTS' IS NEEDED
@@ -790,27 +2687,17 @@ def main():
     print('QS clone pairs by projects')
 
     # sort the projects by no. of clone pairs
-    # copied from
-    # https://stackoverflow.com/questions/6618515/sorting-list-based-on-values-from-another-list
-    projects_sorted = [x for _, x in sorted(zip(pcount, projects), reverse=True)]
-    pcount_sorted = [x for _, x in sorted(zip(pcount, pcount), reverse=True)]
-
-    for idx, p in enumerate(projects_sorted):
-        print(format_project_name(p) + ' & ' + str(pcount_sorted[idx]) + ' \\\\')
+    for p, count in top_projects(dict(zip(projects, pcount))):
+        print(format_project_name(p) + ' & ' + str(count) + ' \\\\')
 
     print()
     print('UD clone pairs by projects')
-    projects, pcount = get_qproject(ud_uclones)
+    projects, pcount = analytics['UD']['uprojects'] if 'UD' in analytics else ([], [])
     print('qualitas projects', len(projects))
 
     # TODO: UNCOMMENT IF LATEX TABLE OF 'QS GROUPED BY PROJECTS' IS NEEDED
-    # copied from
-    # https://stackoverflow.com/questions/6618515/sorting-list-based-on-values-from-another-list
-    projects_sorted = [x for _, x in sorted(zip(pcount, projects), reverse=True)]
-    pcount_sorted = [x for _, x in sorted(zip(pcount, pcount), reverse=True)]
-
-    for idx, p in enumerate(projects_sorted):
-        print(format_project_name(p) + ' & ' + str(pcount_sorted[idx]) + ' \\\\')
+    for p, count in top_projects(dict(zip(projects, pcount))):
+        print(format_project_name(p) + ' & ' + str(count) + ' \\\\')
 
     # TODO: FOR EX CLONE PAIRS
     print()
@@ -826,40 +2713,58 @@ def main():
     # write_clones_to_file(ex_uclones, columns_to_print, file_name, print_header=True, quote_on=True)
     # print('one-sided unique', len(clones))
 
-    # boxplots
-    boxplot(qs_clones, sq_clones, ud_clones, ex_clones, bp_clones, in_clones)
-    boxplot_combined(qs_clones, sq_clones, ud_clones, ex_clones, bp_clones, in_clones)
-    # boxplot_post_age([qs_clones, ex_clones], ['QS', 'EX'])
-    boxplot_post_age([qs_clones], ['QS'])
-
     print('\nCLONE SIZES:')
     print('Clones & Min & Max & Mean & Median \\\\')
     print('QS', end=' & ')
-    stats(get_sizes(qs_clones))
+    stats(analytics['QS']['sizes'])
     print('SQ', end=' & ')
-    stats(get_sizes(sq_clones))
+    stats(analytics['SQ']['sizes'])
     print('UD', end=' & ')
-    stats(get_sizes(ud_clones))
+    stats(analytics['UD']['sizes'])
     print('EX', end=' & ')
-    stats(get_sizes(ex_clones))
+    stats(analytics['EX']['sizes'])
     print('BP', end=' & ')
-    stats(get_sizes(bp_clones))
+    stats(analytics['BP']['sizes'])
     print('IN', end=' & ')
-    stats(get_sizes(in_clones))
+    stats(analytics['IN']['sizes'])
 
     print()
     print('-' * 60)
 
+
+@stage('clean', 'partition')
+def stage_plots(results, args):
+    _, table = results['clean']
+    partitions = results['partition']
+    qs_clones, sq_clones, ud_clones, ex_clones, bp_clones, in_clones = \
+        [get_partition(partitions, c)[1] for c in ['QS', 'SQ', 'UD', 'EX', 'BP', 'IN']]
+
+    # boxplots
+    size_data = [table.subset(clones) for clones in [qs_clones, sq_clones, ud_clones, ex_clones, bp_clones, in_clones]]
+    specs = [boxplot_spec(*size_data), boxplot_combined_spec(*size_data)]
+    # specs.append(boxplot_post_age_spec([qs_clones, ex_clones], ['QS', 'EX']))
+    specs.append(boxplot_post_age_spec([qs_clones], ['QS']))
+    render_figures(specs, workers=args.jobs if args.jobs > 1 else None)
+
+
+@stage('partition', cache=True)
+def stage_outdated(results, args):
+    qs_uclones, _, _ = get_partition(results['partition'], "QS")
+    return outdated_analytics(qs_uclones)
+
+
+@stage('outdated')
+def stage_rq3(results, args):
+    report = results['outdated']
+
     print("RQ3:")
-    outdated_clones = get_outdated_clones(qs_uclones)
+    outdated_clones = report.outdated
     print('outdated', len(outdated_clones))
-    comment_count, changed = count_od_comment_outdated(outdated_clones)
-    print('oudated with comments (yes/no/not found: changed)', comment_count, changed)
-    newer, higher_votes = count_newer_higher_votes(outdated_clones)
-    print('newer answers', newer)
-    print('higher-voted answers (yes/equal)', higher_votes)
+    print('oudated with comments (yes/no/not found: changed)', report.comment_count, report.changed)
+    print('newer answers', report.newer)
+    print('higher-voted answers (yes/equal)', report.higher_votes)
     print('intents of changes')
-    print(count_outdated_reason(outdated_clones))
+    print(report.reasons)
     # exit()
     # print_no_date_clones(qs_clones)
     # print_no_date_clones(ex_clones)
@@ -867,32 +2772,24 @@ def main():
     # write outdated clones to a file
     # write_outdated_clones_to_file(outdated_clones)
 
-    # o_projs = get_projects_having_outdated_clones(qs_uclones)
     # OrderDict is suggested by
     # https://stackoverflow.com/questions/613183/how-to-sort-a-dictionary-by-value
-    # o_projs_sorted = OrderedDict(sorted(o_projs.items(), key=lambda t: t[1], reverse=True))
+    # o_projs_sorted = OrderedDict(sorted(report.short_projects.items(), key=lambda t: t[1], reverse=True))
     # print(o_projs_sorted)
 
     # TODO: UNCOMMENT IF THE PLOT 'OUTDATED CODE GROUPED BY PROJECTS" IS NEEDED
     # plot_outdated(o_projs_sorted)
 
-    mod_types = get_code_mod_types(qs_uclones)
-    print('mod types', mod_types)
+    print('mod types', report.mod_types)
     # TODO: UNCOMMENT IF THE PLOT 'MODIFICATIONS MADE TO OUTDATED CODE' IS NEEDED
-    # plot_mod_types(mod_types)
+    # plot_mod_types(report.mod_types)
 
-    issues_clones = get_outdated_with_issues(qs_uclones)
-    print('no. of unique & outdated SO snippets & having issue', len(issues_clones))
-    outdated_clones = get_outdated_clones(qs_uclones)
-    print('no. of unique & outdated SO snippets (' + classification + ')', len(outdated_clones))
-    projects, pcount = get_qproject(outdated_clones)
-    print('no. qualitas projects containing outdated code', len(projects))
+    print('no. of unique & outdated SO snippets & having issue', len(report.issues))
+    print('no. of unique & outdated SO snippets (QS)', len(outdated_clones))
+    print('no. qualitas projects containing outdated code', len(report.projects))
 
-    # projects_sorted = [x for _, x in sorted(zip(pcount, projects), reverse=True)]
-    # pcount_sorted = [x for _, x in sorted(zip(pcount, pcount), reverse=True)]
-    #
-    # for idx, p in enumerate(projects_sorted):
-    #     print(format_project_name(p) + ' & ' + str(pcount_sorted[idx]) + ' \\\\')
+    # for p, count in top_projects(dict(zip(report.projects, report.pcount))):
+    #     print(format_project_name(p) + ' & ' + str(count) + ' \\\\')
     #
     # # print outdated clones to a file
     # file_name = "outdated_clones.csv"
@@ -905,6 +2802,15 @@ def main():
     print()
     print('-' * 60)
 
+
+@stage('partition', 'analytics')
+def stage_rq4(results, args):
+    partitions = results['partition']
+    analytics = results['analytics']
+    _, _, qs_usnippets = get_partition(partitions, "QS")
+    _, _, ex_usnippets = get_partition(partitions, "EX")
+    _, _, ud_usnippets = get_partition(partitions, "UD")
+
     print('RQ4:')
     print('license analysis using Ninka')
 
@@ -916,27 +2822,132 @@ def main():
     # update_license('IN', allclones)
     # update_license('AC', allclones)
 
-    qs_usnippets, _ = get_unique_so_snippets(qs_uclones)
-    delete_file('clone_licenses.csv')
-    print('>> QS (', len(qs_usnippets), ')')
-    qs_licenses = get_license("QS", qs_usnippets)
-    for key, value in qs_licenses.items():
-        print(key + ' & ' + str(value) + ' \\\\ ')
-    print()
+    with LicenseReportWriter('clone_licenses.csv') as writer:
+        print('>> QS (', len(qs_usnippets), ')')
+        writer.write("QS", qs_usnippets)
+        qs_licenses = analytics["QS"]['licenses'] if "QS" in analytics else dict()
+        for key, value in qs_licenses.items():
+            print(key + ' & ' + str(value) + ' \\\\ ')
+        print()
+
+        print('>> EX (', len(ex_usnippets), ')')
+        writer.write("EX", ex_usnippets)
+        ex_licenses = analytics["EX"]['licenses'] if "EX" in analytics else dict()
+        for key, value in ex_licenses.items():
+            print(key + ' & ' + str(value) + ' \\\\ ')
+        print()
+
+        print('>> UD (', len(ud_usnippets), ')')
+        writer.write("UD", ud_usnippets)
+        ud_licenses = analytics["UD"]['licenses'] if "UD" in analytics else dict()
+        for key, value in ud_licenses.items():
+            print(key + ' & ' + str(value) + ' \\\\ ')
+        print()
+
+
+def resolve_stages(requested):
+    """
+    :return: the requested stages and the stages they depend on, in pipeline order
+    """
+    needed = set()
+    todo = list(requested)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(STAGES[name][1])
+    return [name for name in STAGES if name in needed]
+
+
+def run_stages(requested, args):
+    results = dict()
+    cache = None
+    for name in resolve_stages(requested):
+        fn, _, cacheable, _ = STAGES[name]
+        if cacheable and cache is not None:
+            found, result = cache.load(name)
+            if found:
+                print('loaded', name, 'from', cache.file(name))
+                results[name] = result
+                continue
+        results[name] = fn(results, args)
+        if cacheable and cache is not None:
+            cache.save(name, results[name])
+        if name == 'download' and args.cache:
+            cache = StageCache(results['download'], args)
+    return results
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="A Python script for processing data for Cloverflow study.")
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run pipeline stages (default: all of them)')
+    run.add_argument('stages', nargs='*', choices=list(STAGES) + ['all'], default='all',
+                     help='stages to run, their inputs are run first')
+    run.add_argument('--sync', action='store_true', help='fetch new and changed pairs into the snapshot first')
+    run.add_argument('--full-sync', action='store_true',
+                     help='download all the pairs again, for edits --sync cannot see (see sync_clones)')
+    run.add_argument('--jobs', type=int, default=1,
+                     help='analyse the classifications in that many processes')
+    run.add_argument('--similarity', type=float, default=0.8,
+                     help='min. token similarity (0-1) of near-duplicate snippets in a cluster')
+    run.add_argument('--num-perm', type=int, default=128, help='length of the MinHash signatures')
+    run.add_argument('--shingle-size', type=int, default=3, help='no. of tokens per shingle')
+    run.add_argument('--no-cache', dest='cache', action='store_false',
+                     help='recompute the cached stage results (' + STAGE_CACHE_DIR + ')')
+    compact = commands.add_parser('compact-license-cache', help='shrink the ninka license cache')
+    compact.add_argument('max_age_days', nargs='?', type=float, help='also drop results unused for that many days')
+    benchmark = commands.add_parser('startup-benchmark', help='check the import time of this script')
+    benchmark.add_argument('budget_ms', nargs='?', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    if args.command == 'compact-license-cache':
+        LicenseCache().compact(args.max_age_days)
+        return
+    if args.command == 'startup-benchmark':
+        sys.exit(0 if startup_benchmark(args.budget_ms) else 1)
+    if args.command is None:
+        args = run.parse_args([])
 
-    ex_usnippets, _ = get_unique_so_snippets(ex_uclones)
-    print('>> EX (', len(ex_usnippets), ')')
-    ex_licenses = get_license("EX", ex_usnippets)
-    for key, value in ex_licenses.items():
-        print(key + ' & ' + str(value) + ' \\\\ ')
-    print()
+    # TODO: uncomment this if you want to find median or any stats about SO snippets
+    # filesizes, summary = get_file_size('/Users/Chaiyong/Downloads/stackoverflow/stackoverflow_formatted')
+    # print(summary)
+    # median = statistics.median(filesizes)
+    # print('median file size of ' + str(len(filesizes)) + ' = ' + str(median))
+
+    print("A Python script for processing data for Cloverflow study.")
+    stages = args.stages if args.stages != 'all' and 'all' not in args.stages else list(STAGES)
+    run_stages(stages, args)
 
-    ud_usnippets, _ = get_unique_so_snippets(ud_uclones)
-    print('>> UD (', len(ud_usnippets), ')')
-    ud_licenses = get_license("UD", ud_usnippets)
-    for key, value in ud_licenses.items():
-        print(key + ' & ' + str(value) + ' \\\\ ')
-    print()
 
+HEAVY_MODULES = ['firebase_admin', 'matplotlib', 'glob2', 'dateutil']
 
-main()
\ No newline at end of file
+
+def startup_benchmark(budget_ms=500, python=sys.executable):
+    """
+    Import this module in a fresh interpreter with -X importtime and check that it stays
+    within the budget and does not load the Firebase or plotting dependencies
+    :return: True if the import is within the budget and no heavy module was loaded
+    """
+    module = Path(__file__).stem
+    p = Popen([python, '-X', 'importtime', '-c', 'import ' + module],
+              cwd=str(Path(__file__).resolve().parent), stdout=PIPE, stderr=PIPE)
+    _, err = p.communicate()
+    # lines look like: import time:       self [us] |  cumulative | imported package
+    imported = dict()
+    for line in err.decode('utf-8').splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, package = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                imported[package.strip()] = int(cumulative)
+    total_ms = imported.get(module, 0) / 1000
+    heavy = sorted(m for m in imported if m.split('.')[0] in HEAVY_MODULES)
+    print('import', module + ':', '%.1f ms' % total_ms, '(budget %d ms)' % budget_ms)
+    if heavy:
+        print('heavy modules imported at startup:', ', '.join(heavy))
+    return p.returncode == 0 and module in imported and total_ms <= budget_ms and not heavy
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from qs_clone_processor import LicenseCache, ninka_license, scan_licenses
+
+# prints what ninka -d prints; a file containing "slow" keeps a child process (and the output pipe) busy
+STUB_NINKA = '''#!/bin/sh
+echo "$2" >> "$NINKA_LOG"
+if grep -q slow "$2"; then
+    sleep 30
+fi
+echo "$2;GPLv2,Apache-2;spdx;unknown"
+'''
+
+
+@pytest.fixture
+def ninka(tmp_path, monkeypatch):
+    script = tmp_path / 'ninka.pl'
+    script.write_text(STUB_NINKA)
+    script.chmod(0o755)
+    log = tmp_path / 'ninka.log'
+    log.write_text('')
+    monkeypatch.setenv('NINKA_LOG', str(log))
+    return str(script), log
+
+
+def write(tmp_path, name, text):
+    file = tmp_path / name
+    file.write_text(text)
+    return str(file)
+
+
+def test_ninka_license(ninka, tmp_path):
+    script, _ = ninka
+    assert ninka_license(write(tmp_path, 'A.java', 'class A {}'), script, timeout=10) == 'GPLv2/Apache-2'
+
+
+def test_ninka_timeout_kills_its_children(ninka, tmp_path):
+    script, _ = ninka
+    started = time.time()
+    assert ninka_license(write(tmp_path, 'Slow.java', 'slow'), script, timeout=1) is None
+    assert time.time() - started < 5
+
+
+def test_scan_licenses_once_per_content(ninka, tmp_path):
+    script, log = ninka
+    files = [write(tmp_path, 'A.java', 'class A {}'), write(tmp_path, 'B.java', 'class A {}'),
+             write(tmp_path, 'C.java', 'class C {}')]
+    files.append(files[0])
+    cache = LicenseCache(str(tmp_path / 'licenses.db'), version='stub')
+    assert scan_licenses(files, script, workers=2, cache=cache) == ['GPLv2/Apache-2'] * 4
+    assert len(log.read_text().split()) == 2
+
+    # the same content under another name is answered from the cache
+    files.append(write(tmp_path, 'D.java', 'class C {}'))
+    assert scan_licenses(files, script, workers=2, cache=cache) == ['GPLv2/Apache-2'] * 5
+    assert len(log.read_text().split()) == 2
+    cache.close()
@@ -0,0 +1,11 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from qs_clone_processor import startup_benchmark
+
+
+def test_import_within_budget_without_heavy_modules():
+    # the stats-only path must not pay for Firebase, plotting or the stage machinery
+    assert startup_benchmark(budget_ms=500)
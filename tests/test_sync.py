@@ -0,0 +1,105 @@
+import json
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from qs_clone_processor import Snapshot, UPDATED_AT, sync_clones, write_snapshot
+
+
+def make_pair(key, changed, code='int x = 1;\n'):
+    return {'file1': 'so/%d.java' % key, 'file2': 'proj%d/src/A.java' % (key % 3),
+            'start1': 1, 'end1': 1, 'start2': 1, 'end2': 1,
+            'code1': code, 'code2': code, 'classification': 'QS',
+            'latest_change_date': changed, 'latest_ischanged': 'false'}
+
+
+class RestStandIn(BaseHTTPRequestHandler):
+    """ answers the ordered queries of the Realtime Database REST API from a dict of key -> pair """
+    pairs = dict()
+    requests = []
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = {k: json.loads(v) for k, v in urllib.parse.parse_qsl(url.query) if k != 'access_token'}
+        self.requests.append(query)
+        order_by, start = query['orderBy'], query['startAt']
+        if order_by == '$key':
+            items = sorted((key, pair) for key, pair in self.pairs.items() if key >= int(start))
+        else:
+            items = sorted(((pair[order_by], key), pair) for key, pair in self.pairs.items()
+                           if order_by in pair and pair[order_by] >= start)
+            items = [(key, pair) for (_, key), pair in items]
+        body = json.dumps({str(key): pair for key, pair in items[:query['limitToFirst']]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def db():
+    RestStandIn.pairs = {key: make_pair(key, 1000 + key) for key in range(50)}
+    RestStandIn.requests = []
+    server = HTTPServer(('127.0.0.1', 0), RestStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield RestStandIn, 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def sync(snapshot_file, base_url):
+    return sync_clones(str(snapshot_file), page_size=10, base_url=base_url, access_token='test')
+
+
+def test_sync_picks_up_new_and_changed_pairs(db, tmp_path):
+    stand_in, base_url = db
+    snapshot_file = tmp_path / 'allclones.snapshot'
+    write_snapshot(dict(stand_in.pairs), str(snapshot_file))
+
+    stand_in.pairs[50] = make_pair(50, 1050)
+    stand_in.pairs[7] = make_pair(7, 2000, code='int x = 2;\n')
+    stand_in.pairs[8] = dict(stand_in.pairs[8], classification='EX', **{UPDATED_AT: 3000})
+    assert sync(snapshot_file, base_url) == (1, 2)
+
+    clones = {clone['file1']: clone for clone in Snapshot(str(snapshot_file)).clones()}
+    assert len(clones) == 51
+    assert clones['so/7.java']['code1'] == 'int x = 2;\n'
+    assert clones['so/8.java']['classification'] == 'EX'
+
+
+def test_sync_without_changes_fetches_nothing(db, tmp_path):
+    stand_in, base_url = db
+    # many pairs at the newest change date, more than a page
+    for key in range(20, 50):
+        stand_in.pairs[key]['latest_change_date'] = 5000
+    snapshot_file = tmp_path / 'allclones.snapshot'
+    write_snapshot(dict(stand_in.pairs), str(snapshot_file))
+    assert sync(snapshot_file, base_url) == (0, 0)
+
+    stand_in.requests.clear()
+    stand_in.pairs = {key: dict(pair) for key, pair in stand_in.pairs.items()}
+    assert sync(snapshot_file, base_url) == (0, 0)
+    # one (empty) page per watermark: key, latest_change_date and updated_at
+    assert len(stand_in.requests) == 3
+
+
+def test_sync_pages_through_pairs_sharing_a_change_date(db, tmp_path):
+    stand_in, base_url = db
+    snapshot_file = tmp_path / 'allclones.snapshot'
+    write_snapshot(dict(stand_in.pairs), str(snapshot_file))
+
+    for key in range(0, 45):
+        stand_in.pairs[key] = dict(stand_in.pairs[key], latest_change_date=6000 + key // 20,
+                                   latest_ischanged='true')
+    assert sync(snapshot_file, base_url) == (0, 45)
+    assert sum(clone['latest_ischanged'] == 'true' for clone in Snapshot(str(snapshot_file)).clones()) == 45